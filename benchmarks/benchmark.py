@@ -0,0 +1,334 @@
+"""
+Benchmark the collector against fake Plex servers and a fake InfluxDB.
+
+Runs one cold single run (connecting, recently added, libraries, sessions) and then times each collector on its
+own for a number of warm cycles.  Reports wall and CPU time, Plex requests and bytes, InfluxDB writes, lines and
+bytes and peak memory.  Results can be saved as JSON and compared against a saved baseline to catch regressions.
+
+    python benchmarks/benchmark.py --servers 10 --streams 100 --library-size 10000
+"""
+import argparse
+import configparser
+import json
+import multiprocessing
+import os
+import resource
+import socket
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Dict, List
+from urllib.request import urlopen
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fakeinflux  # noqa: E402
+import fakeplex  # noqa: E402
+
+# Fields compared against a baseline and whether they must match exactly, timings are compared with a tolerance
+COMPARED_FIELDS = {
+    'wall_s': False,
+    'cpu_s': False,
+    'plex_requests': True,
+    'plex_bytes': True,
+    'influx_lines': True,
+}
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _wait_for_port(address: str, port: int, timeout: float = 10):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection((address, port), timeout=1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def _counters(url: str) -> dict:
+    with urlopen(url + '/__counters__') as r:
+        return json.load(r)
+
+
+def write_config(path: str, args, addresses: List[str], plex_port: int, influx_port: int):
+    """
+    Write a collector config pointing at the fake servers
+    """
+    config = configparser.ConfigParser()
+    config.optionxform = str
+    config['GENERAL'] = {
+        'Delay': '10',
+        'ReportCombined': 'True',
+        'StateDir': 'state',
+        'SessionStore': args.session_store,
+        'PollWorkers': str(args.poll_workers),
+        'ServerTimeout': '60',
+        'LibraryCountOnly': str(not args.full_library_scan),
+        'LibraryIncremental': str(not args.no_incremental),
+        'NowPlayingDelta': str(args.now_playing_delta),
+    }
+    config['INFLUXDB'] = {
+        'Version': str(args.influx_version),
+        'Address': '127.0.0.1',
+        'Port': str(influx_port),
+        'Database': 'plex_data',
+        'Token': 'benchmark',
+        'Org': 'benchmark',
+        'Gzip': str(args.gzip),
+        'Spool': str(args.influx_down),
+        'BatchSize': str(args.batch_size),
+        'FlushInterval': '0',
+    }
+    config['PLEX'] = {
+        'Username': 'benchmark',
+        'Password': 'benchmark',
+        'Servers': ','.join(addresses),
+        'HTTPS': 'False',
+        'Port': str(plex_port),
+        'Retries': '0',
+    }
+    config['STATS'] = {
+        'Interval': '0',
+    }
+    config['LOGGING'] = {
+        'Level': args.log_level,
+    }
+    with open(path, 'w') as f:
+        config.write(f)
+
+
+class Benchmark:
+    """
+    Measures phases of collector work against the fake servers
+    """
+
+    def __init__(self, plex_urls: List[str], influx_url: str, trace_memory: bool):
+        self.plex_urls = plex_urls
+        self.influx_url = influx_url
+        self.trace_memory = trace_memory
+        self.results: Dict[str, dict] = {}
+
+    def _snapshot(self) -> dict:
+        plex = [_counters(url) for url in self.plex_urls]
+        influx = _counters(self.influx_url)
+        return {
+            'plex_requests': sum(server['requests'] for server in plex),
+            'plex_bytes': sum(server['bytes'] for server in plex),
+            'influx_writes': influx['writes'],
+            'influx_lines': influx['lines'],
+            'influx_bytes': influx['bytes'],
+        }
+
+    def measure(self, name: str, func: Callable[[], None]):
+        """
+        Run func and record what it cost under name.  Repeated phases are added together
+        """
+        before = self._snapshot()
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        wall, cpu = time.perf_counter(), time.process_time()
+
+        func()
+
+        result = {
+            'wall_s': time.perf_counter() - wall,
+            'cpu_s': time.process_time() - cpu,
+        }
+        after = self._snapshot()
+        result.update({key: after[key] - before[key] for key in after})
+        if self.trace_memory:
+            result['peak_traced_mb'] = tracemalloc.get_traced_memory()[1] / 1024 / 1024
+
+        total = self.results.setdefault(name, {'runs': 0})
+        total['runs'] += 1
+        for key, value in result.items():
+            if key == 'peak_traced_mb':
+                total[key] = max(total.get(key, 0), value)
+            else:
+                total[key] = total.get(key, 0) + value
+
+    def averages(self) -> Dict[str, dict]:
+        return {
+            name: {
+                key: value if key in ('runs', 'peak_traced_mb') else value / total['runs']
+                for key, value in total.items()
+            }
+            for name, total in self.results.items()
+        }
+
+
+def run_collector(args, bench: Benchmark):
+    # The config is loaded when plexcollector is first imported, so it can only be imported now
+    from plexcollector.PlexInfluxdbCollector import PlexInfluxdbCollector
+
+    collector = PlexInfluxdbCollector(single_run=True)
+    bench.measure('single_run', collector.run)
+
+    def flushed(func):
+        def phase():
+            func()
+            collector.flush_influx_data()
+        return phase
+
+    phases = {
+        'sessions': flushed(collector.get_active_streams),
+        'recently_added': flushed(collector.get_recently_added),
+        'libraries': flushed(collector.get_library_data),
+    }
+    for _ in range(args.cycles):
+        for name, phase in phases.items():
+            if name in args.phases:
+                bench.measure(name, phase)
+
+
+def report(results: Dict[str, dict], max_rss_mb: float):
+    columns = ('runs', 'wall_s', 'cpu_s', 'plex_requests', 'plex_bytes', 'influx_writes', 'influx_lines',
+               'influx_bytes', 'peak_traced_mb')
+    columns = [column for column in columns if any(column in result for result in results.values())]
+    print('{:<16}'.format('phase') + ''.join('{:>16}'.format(column) for column in columns))
+    for name, result in results.items():
+        cells = []
+        for column in columns:
+            value = result.get(column, '')
+            if column in ('wall_s', 'cpu_s', 'peak_traced_mb'):
+                cells.append('{:>16.3f}'.format(value))
+            elif isinstance(value, float):
+                # Counts averaged over the runs of a phase
+                cells.append('{:>16.1f}'.format(value))
+            else:
+                cells.append('{:>16}'.format(value))
+        print('{:<16}'.format(name) + ''.join(cells))
+    print('Peak RSS of the collector process: {:.1f} MB'.format(max_rss_mb))
+
+
+def compare(results: Dict[str, dict], baseline: Dict[str, dict], tolerance: float) -> List[str]:
+    """
+    Find phases that got slower than the tolerance allows or do more work than the baseline
+    :return: Description of every regression
+    """
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        for field, exact in COMPARED_FIELDS.items():
+            if field not in result or field not in base:
+                continue
+            limit = base[field] if exact else base[field] * (1 + tolerance)
+            # Timings under 10ms are too noisy to compare
+            if result[field] > limit and (exact or result[field] > 0.01):
+                regressions.append('{} {}: {:.3f} > baseline {:.3f}'.format(name, field, result[field], base[field]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the collector against fake Plex and InfluxDB servers')
+    parser.add_argument('--servers', type=int, default=1, help='Number of fake Plex servers (1-254)')
+    parser.add_argument('--streams', type=int, default=10, help='Active sessions per server (0-500)')
+    parser.add_argument('--library-size', type=int, default=1000, help='Items in each of the three libraries')
+    parser.add_argument('--cycles', type=int, default=5, help='Warm runs of each collector')
+    parser.add_argument('--phases', nargs='+', default=['sessions', 'recently_added', 'libraries'],
+                        choices=['sessions', 'recently_added', 'libraries'], help='Collectors timed in warm runs')
+    parser.add_argument('--fixtures', help='Directory of recorded Plex XML responses served instead of synthetic ones')
+    parser.add_argument('--poll-workers', type=int, default=8)
+    parser.add_argument('--session-store', default='memory', choices=['memory', 'file', 'sqlite'])
+    parser.add_argument('--full-library-scan', action='store_true', help='Count libraries by fetching every item')
+    parser.add_argument('--no-incremental', action='store_true', help='Rescan unchanged libraries every run')
+    parser.add_argument('--now-playing-delta', action='store_true')
+    parser.add_argument('--influx-version', type=int, default=1, choices=[1, 2])
+    parser.add_argument('--gzip', action='store_true')
+    parser.add_argument('--batch-size', type=int, default=5000)
+    parser.add_argument('--influx-down', action='store_true', help='Reject every write so points are spooled')
+    parser.add_argument('--tracemalloc', action='store_true',
+                        help='Trace peak Python memory of each phase, slows everything down')
+    parser.add_argument('--log-level', default='warning')
+    parser.add_argument('--json', help='Save the results to this file')
+    parser.add_argument('--baseline', help='Compare against results saved with --json, exits 1 on regressions')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed slowdown against the baseline')
+    args = parser.parse_args()
+
+    if not 1 <= args.servers <= 254:
+        parser.error('--servers must be between 1 and 254')
+    # The collector runs in a temporary directory
+    for name in ('fixtures', 'json', 'baseline'):
+        if getattr(args, name):
+            setattr(args, name, os.path.abspath(getattr(args, name)))
+
+    # Every fake server gets its own loopback address as the collector uses a single port for all servers
+    addresses = ['127.0.0.{}'.format(i + 1) for i in range(args.servers)]
+    plex_port = _free_port()
+    influx_port = _free_port()
+
+    processes = [
+        multiprocessing.Process(
+            target=fakeplex.serve,
+            args=(addresses, plex_port, args.streams, args.library_size, args.fixtures),
+            daemon=True
+        ),
+        multiprocessing.Process(
+            target=fakeinflux.serve,
+            args=('127.0.0.1', influx_port, 'plex_data', args.influx_down),
+            daemon=True
+        ),
+    ]
+    for process in processes:
+        process.start()
+
+    try:
+        for address in addresses:
+            _wait_for_port(address, plex_port)
+        _wait_for_port('127.0.0.1', influx_port)
+
+        workdir = tempfile.mkdtemp(prefix='plexcollector-benchmark-')
+        write_config(os.path.join(workdir, 'config.ini'), args, addresses, plex_port, influx_port)
+        # A cached token keeps plex.tv out of the benchmark
+        os.makedirs(os.path.join(workdir, 'state'))
+        with open(os.path.join(workdir, 'state', 'token.json'), 'w') as f:
+            json.dump({'username': 'benchmark', 'token': 'benchmark', 'fetched_at': time.time()}, f)
+
+        os.chdir(workdir)
+        os.environ['devconfig'] = 'config.ini'
+
+        bench = Benchmark(
+            ['http://{}:{}'.format(address, plex_port) for address in addresses],
+            'http://127.0.0.1:{}'.format(influx_port),
+            args.tracemalloc
+        )
+        if args.tracemalloc:
+            tracemalloc.start()
+        run_collector(args, bench)
+    finally:
+        for process in processes:
+            process.terminate()
+
+    results = bench.averages()
+    print()
+    print('{} servers, {} streams per server, {} items per library, {} warm cycles'.format(
+        args.servers, args.streams, args.library_size, args.cycles
+    ))
+    report(results, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION: ' + regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
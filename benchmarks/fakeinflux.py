@@ -0,0 +1,141 @@
+"""
+Fake InfluxDB accepting 1.x and 2.x line protocol writes, used to benchmark the collector without a real database.
+Writes are counted and thrown away
+"""
+import argparse
+import gzip
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict
+from urllib.parse import urlparse
+
+
+class FakeInflux:
+    """
+    Counters of the writes received
+    """
+
+    def __init__(self, bucket: str = 'plex_data', fail_writes: bool = False):
+        self.bucket = bucket
+        self.fail_writes = fail_writes
+        self.writes = 0
+        self.lines = 0
+        self.bytes = 0  # As received, so compressed when gzip is enabled
+        self.measurements: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def record(self, body: bytes, size: int):
+        lines = [line for line in body.decode('utf-8').split('\n') if line]
+        with self._lock:
+            self.writes += 1
+            self.lines += len(lines)
+            self.bytes += size
+            for line in lines:
+                # Measurement names end at the first unescaped comma or space
+                end = 0
+                while end < len(line) and line[end] not in ', ':
+                    end += 2 if line[end] == '\\' else 1
+                measurement = line[:end]
+                self.measurements[measurement] = self.measurements.get(measurement, 0) + 1
+
+    def counters(self) -> dict:
+        with self._lock:
+            return {
+                'writes': self.writes,
+                'lines': self.lines,
+                'bytes': self.bytes,
+                'measurements': dict(self.measurements),
+            }
+
+
+class FakeInfluxHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server: 'FakeInfluxHTTPServer'
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        influx = self.server.influx
+        if path == '/__counters__':
+            self._send(200, influx.counters())
+        elif path == '/ping':
+            self._send(204)
+        elif path == '/query':
+            # SHOW USERS and CREATE DATABASE, all the collector ever asks
+            self._send(200, {'results': [{'statement_id': 0}]})
+        elif path == '/api/v2/buckets':
+            self._send(200, {'buckets': [{'name': influx.bucket}]})
+        else:
+            self._send(404)
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        influx = self.server.influx
+        if path == '/query':
+            self._send(200, {'results': [{'statement_id': 0}]})
+            return
+        if path not in ('/write', '/api/v2/write'):
+            self._send(404)
+            return
+        if influx.fail_writes:
+            self._send(503, {'error': 'fake outage'})
+            return
+
+        size = len(body)
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        influx.record(body, size)
+        self._send(204)
+
+    def _send(self, status: int, data: dict = None):
+        body = json.dumps(data).encode('utf-8') if data is not None else b''
+        self.send_response(status)
+        if data is not None:
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeInfluxHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: str, port: int, influx: FakeInflux):
+        super().__init__((address, port), FakeInfluxHandler)
+        self.influx = influx
+
+
+def serve(address: str, port: int, bucket: str = 'plex_data', fail_writes: bool = False, ready=None):
+    """
+    Serve a fake InfluxDB until interrupted
+    :param address:
+    :param port:
+    :param bucket: Bucket reported to exist to 2.x clients
+    :param fail_writes: Reject every write, to measure spooling
+    :param ready: Event set once the server is listening
+    :return:
+    """
+    server = FakeInfluxHTTPServer(address, port, FakeInflux(bucket, fail_writes))
+    if ready is not None:
+        ready.set()
+    server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve a fake InfluxDB that counts and discards writes')
+    parser.add_argument('--address', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8086)
+    parser.add_argument('--bucket', default='plex_data')
+    parser.add_argument('--fail-writes', action='store_true', help='Reject every write')
+    args = parser.parse_args()
+
+    print('Serving fake InfluxDB on {}:{}'.format(args.address, args.port))
+    serve(args.address, args.port, args.bucket, args.fail_writes)
+
+
+if __name__ == '__main__':
+    main()
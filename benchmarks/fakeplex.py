@@ -0,0 +1,512 @@
+"""
+Fake Plex Media Server serving synthetic XML, used to benchmark the collector without a real server.
+
+Every server has a movie, a TV show and a music library holding library_size leaf items each, and
+streams active sessions.  Responses can be replaced by recorded XML: a file in the fixtures directory
+named after the request path (/status/sessions -> status_sessions.xml) is served as is.
+"""
+import argparse
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+from urllib.parse import urlparse, parse_qs
+from xml.sax.saxutils import quoteattr
+
+SEARCH_TYPES = {
+    1: 'movie',
+    2: 'show',
+    3: 'season',
+    4: 'episode',
+    8: 'artist',
+    9: 'album',
+    10: 'track',
+}
+
+# Section key -> (title, section type, item types from top level to leaf)
+SECTIONS = {
+    1: ('Movies', 'movie', ('movie',)),
+    2: ('TV Shows', 'show', ('show', 'season', 'episode')),
+    3: ('Music', 'artist', ('artist', 'album', 'track')),
+}
+
+# Item type -> (XML tag, leaf items per item)
+ITEMS = {
+    'movie': ('Video', 1),
+    'show': ('Directory', 50),
+    'season': ('Directory', 10),
+    'episode': ('Video', 1),
+    'artist': ('Directory', 100),
+    'album': ('Directory', 10),
+    'track': ('Track', 1),
+}
+
+PLAYER_STATES = ('playing',) * 16 + ('paused',) * 3 + ('buffering',)
+PLATFORMS = ('Chrome', 'Roku', 'iOS', 'Android', 'Apple TV', 'Plex Web')
+RESOLUTIONS = ('sd', '720', '1080', '4k')
+
+
+def _attrs(**attrs) -> str:
+    return ' '.join('{}={}'.format(key, quoteattr(str(value))) for key, value in attrs.items() if value is not None)
+
+
+class FakePlex:
+    """
+    State of one fake server
+    """
+
+    def __init__(self, name: str, streams: int, library_size: int, fixtures: Optional[str] = None):
+        self.name = name
+        self.streams = streams
+        self.library_size = library_size
+        self.fixtures = fixtures
+        self.started = int(time.time())
+        self.requests = 0
+        self.bytes = 0
+        self.paths: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def record(self, path: str, size: int):
+        with self._lock:
+            self.requests += 1
+            self.bytes += size
+            self.paths[path] = self.paths.get(path, 0) + 1
+
+    def counters(self) -> dict:
+        with self._lock:
+            return {'requests': self.requests, 'bytes': self.bytes, 'paths': dict(self.paths)}
+
+    def count(self, item_type: str) -> int:
+        """
+        Number of items of a type in its library
+        """
+        leaf_type = next(types[-1] for _, _, types in SECTIONS.values() if item_type in types)
+        if item_type == leaf_type:
+            return self.library_size
+        size = ITEMS[item_type][1]
+        if item_type in ('show', 'artist'):
+            return max(self.library_size // size, 1)
+        parent = 'show' if item_type == 'season' else 'artist'
+        return self.count(parent) * (ITEMS[parent][1] // size)
+
+    def fixture(self, path: str) -> Optional[bytes]:
+        if not self.fixtures:
+            return None
+        name = path.strip('/').replace('/', '_') or 'root'
+        file = os.path.join(self.fixtures, name + '.xml')
+        if not os.path.isfile(file):
+            return None
+        with open(file, 'rb') as f:
+            return f.read()
+
+    def root(self) -> str:
+        return '<MediaContainer {}/>'.format(_attrs(
+            size=0,
+            friendlyName=self.name,
+            machineIdentifier='fake-{}'.format(self.name),
+            version='1.40.0.7998',
+            platform='Linux',
+            myPlex=0,
+            transcoderActiveVideoSessions=0,
+        ))
+
+    @staticmethod
+    def library() -> str:
+        return (
+            '<MediaContainer size="1" title1="Plex Library">'
+            '<Directory key="sections" title="Library Sections"/>'
+            '</MediaContainer>'
+        )
+
+    def sections(self) -> str:
+        directories = []
+        for key, (title, section_type, _) in SECTIONS.items():
+            directories.append('<Directory {}><Location id="{}" path="/data/{}"/></Directory>'.format(
+                _attrs(
+                    key=key,
+                    type=section_type,
+                    title=title,
+                    agent='tv.plex.agents.none',
+                    scanner='Plex Scanner',
+                    language='en-US',
+                    uuid='{}-{}'.format(self.name, key),
+                    createdAt=self.started,
+                    updatedAt=self.started,
+                    scannedAt=self.started,
+                ),
+                key,
+                section_type
+            ))
+        return '<MediaContainer size="{}">{}</MediaContainer>'.format(len(directories), ''.join(directories))
+
+    @staticmethod
+    def meta(section_key: int) -> str:
+        """
+        Filter and sort metadata plexapi loads to validate searches
+        """
+        types = []
+        for item_type in SECTIONS[section_key][2]:
+            types.append(
+                '<Type key="/library/sections/{}/all?type={}" type="{}" title="{}" active="1">'
+                '<Sort defaultDirection="desc" descKey="addedAt:desc" key="addedAt" title="Date Added"/>'
+                '<Sort defaultDirection="asc" descKey="titleSort:desc" key="titleSort" title="Title"/>'
+                '</Type>'.format(
+                    section_key,
+                    next(number for number, name in SEARCH_TYPES.items() if name == item_type),
+                    item_type,
+                    item_type.title()
+                )
+            )
+        return '<Meta>{}<FieldType type="string"><Operator key="=" title="is"/></FieldType></Meta>'.format(
+            ''.join(types)
+        )
+
+    def item(self, section_key: int, item_type: str, index: int) -> str:
+        """
+        XML of the index'th newest item of a type
+        """
+        tag = ITEMS[item_type][0]
+        rating_key = section_key * 10_000_000 + list(SEARCH_TYPES.values()).index(item_type) * 1_000_000 + index
+        attrs = {
+            'ratingKey': rating_key,
+            'key': '/library/metadata/{}'.format(rating_key),
+            'type': item_type,
+            'title': '{} {}'.format(item_type.title(), index + 1),
+            'librarySectionID': section_key,
+            'addedAt': self.started - index * 60,
+            'updatedAt': self.started - index * 60,
+            'index': index % 10 + 1,
+        }
+        if tag == 'Directory':
+            # plexapi reloads items that are missing their child counts
+            leaves = ITEMS[item_type][1]
+            attrs['leafCount'] = leaves
+            attrs['childCount'] = leaves // 10 if item_type in ('show', 'artist') else leaves
+            if item_type == 'show':
+                attrs['childCount'] = 5
+        if item_type == 'episode':
+            attrs['grandparentTitle'] = 'Show {}'.format(index // ITEMS['show'][1] + 1)
+            attrs['parentTitle'] = 'Season {}'.format(index // 10 % 5 + 1)
+            attrs['parentIndex'] = index // 10 % 5 + 1
+            attrs['duration'] = 2_400_000
+        elif item_type == 'track':
+            attrs['grandparentTitle'] = 'Artist {}'.format(index // ITEMS['artist'][1] + 1)
+            attrs['parentTitle'] = 'Album {}'.format(index // 10 + 1)
+            attrs['duration'] = 240_000
+        elif item_type == 'movie':
+            attrs['year'] = 1970 + index % 50
+            attrs['duration'] = 6_600_000
+        return '<{} {}/>'.format(tag, _attrs(**attrs))
+
+    def section_items(self, section_key: int, query: dict, start: int, size: Optional[int]) -> str:
+        types = SECTIONS[section_key][2]
+        item_type = SEARCH_TYPES.get(int(query.get('type', 0)), types[0])
+        if item_type not in types:
+            item_type = types[0]
+        total = self.count(item_type)
+        end = total if size is None else min(start + size, total)
+        items = ''.join(self.item(section_key, item_type, index) for index in range(start, end))
+        meta = self.meta(section_key) if query.get('includeMeta') == '1' else ''
+        return '<MediaContainer {}>{}{}</MediaContainer>'.format(
+            _attrs(size=max(end - start, 0), totalSize=total, offset=start, librarySectionID=section_key),
+            meta,
+            items
+        )
+
+    def recently_added(self, start: int, size: Optional[int]) -> str:
+        # Newest items alternate between the movie and TV show libraries
+        total = min(self.library_size * 2, 500)
+        end = total if size is None else min(start + size, total)
+        items = []
+        for index in range(start, end):
+            section_key, item_type = (1, 'movie') if index % 2 == 0 else (2, 'episode')
+            items.append(self.item(section_key, item_type, index // 2))
+        return '<MediaContainer {}>{}</MediaContainer>'.format(
+            _attrs(size=max(end - start, 0), totalSize=total, offset=start), ''.join(items)
+        )
+
+    def session(self, index: int) -> str:
+        """
+        XML of the index'th active session.  Positions advance in real time
+        """
+        elapsed = int(time.time()) - self.started
+        kind = index % 3
+        if kind == 0:
+            section_key, item_type, tag = 1, 'movie', 'Video'
+        elif kind == 1:
+            section_key, item_type, tag = 2, 'episode', 'Video'
+        else:
+            section_key, item_type, tag = 3, 'track', 'Track'
+
+        item = self.item(section_key, item_type, index)
+        duration = 6_600_000 if item_type == 'movie' else 2_400_000 if item_type == 'episode' else 240_000
+        state = PLAYER_STATES[index % len(PLAYER_STATES)]
+        video_resolution = '{}'.format(320 if item_type == 'track' else RESOLUTIONS[index % len(RESOLUTIONS)])
+        transcoding = index % 4 == 0
+        bitrate = 320 if item_type == 'track' else 4000 + index % 8 * 1000
+
+        children = [
+            '<Media {}><Part {}/></Media>'.format(
+                _attrs(
+                    id=index + 1,
+                    duration=duration,
+                    bitrate=bitrate,
+                    container='mp3' if item_type == 'track' else 'mkv',
+                    videoResolution=video_resolution,
+                    videoCodec=None if item_type == 'track' else 'hevc' if index % 2 else 'h264',
+                    videoFrameRate=None if item_type == 'track' else '24p',
+                    audioCodec='mp3' if item_type == 'track' else 'aac',
+                ),
+                _attrs(id=index + 1, duration=duration, container='mkv')
+            ),
+            '<User {}/>'.format(_attrs(id=index % 25 + 1, title='user{}'.format(index % 25 + 1))),
+            '<Player {}/>'.format(_attrs(
+                address='10.0.{}.{}'.format(index // 250, index % 250 + 1),
+                machineIdentifier='player-{}-{}'.format(self.name, index),
+                title='Player {}'.format(index + 1),
+                platform=PLATFORMS[index % len(PLATFORMS)],
+                product='Plex for {}'.format(PLATFORMS[index % len(PLATFORMS)]),
+                state=state,
+                local=int(index % 5 != 0),
+            )),
+            '<Session {}/>'.format(_attrs(
+                id='{}-session-{}'.format(self.name, index),
+                bandwidth=bitrate + 500,
+                location='wan' if index % 5 == 0 else 'lan',
+            )),
+        ]
+        if transcoding:
+            children.append('<TranscodeSession {}/>'.format(_attrs(
+                key='/transcode/sessions/{}-{}'.format(self.name, index),
+                throttled=int(index % 8 == 0),
+                complete=0,
+                progress=min(elapsed / 10 + index, 100),
+                speed=1.5 if index % 8 else 0.9,
+                duration=duration,
+                videoDecision='transcode' if item_type != 'track' else None,
+                audioDecision='transcode' if index % 3 else 'copy',
+                protocol='dash',
+                container='mp4',
+                videoCodec=None if item_type == 'track' else 'h264',
+                audioCodec='aac',
+                transcodeHwRequested=1,
+                transcodeHwDecoding='vaapi' if index % 12 == 0 else None,
+                transcodeHwEncoding='vaapi' if index % 3 != 2 else None,
+                transcodeHwFullPipeline=int(index % 12 == 0),
+            )))
+
+        # Turn the library item in to a session item
+        offset = (elapsed * 1000 + index * 60_000) % duration
+        return item[:-2] + ' {}>{}</{}>'.format(
+            _attrs(sessionKey=index + 1, viewOffset=offset),
+            ''.join(children),
+            tag
+        )
+
+    def sessions(self) -> str:
+        return '<MediaContainer size="{}">{}</MediaContainer>'.format(
+            self.streams, ''.join(self.session(index) for index in range(self.streams))
+        )
+
+    @staticmethod
+    def _sample_times(after: int = 0) -> List[int]:
+        # Plex keeps a sample every 6 seconds and returns the last few minutes of them
+        newest = int(time.time()) // 6 * 6
+        return [at for at in range(newest - 174, newest + 1, 6) if at > after]
+
+    def resources(self) -> str:
+        samples = []
+        for at in self._sample_times():
+            load = at // 6 % 20
+            samples.append('<StatisticsResources {}/>'.format(_attrs(
+                at=at,
+                timespan=6,
+                hostCpuUtilization=10.0 + load,
+                processCpuUtilization=5.0 + load,
+                hostMemoryUtilization=40.0 + load / 2,
+                processMemoryUtilization=8.0 + load / 4,
+            )))
+        return '<MediaContainer size="{}">{}</MediaContainer>'.format(len(samples), ''.join(samples))
+
+    def bandwidth(self, query: dict) -> str:
+        samples = []
+        for at in self._sample_times(int(query.get('at>', 0)) - 1):
+            for device in range(1, 3):
+                samples.append('<StatisticsBandwidth {}/>'.format(_attrs(
+                    accountID=1,
+                    deviceID=device,
+                    at=at,
+                    lan=int(device == 1),
+                    bytes=self.streams * 500_000 * device,
+                    timespan=6,
+                )))
+        return '<MediaContainer size="{}">{}</MediaContainer>'.format(len(samples), ''.join(samples))
+
+    def history(self, query: dict, start: int, size: Optional[int]) -> str:
+        """
+        Watch history, one entry every 10 minutes going back from when the server started, as many as there are
+        items in a library
+        """
+        total = self.library_size
+        viewed_after = int(query.get('viewedAt>', 0))
+        # Oldest entry first, matching sort=viewedAt:asc which is all the collector asks for
+        indexes = [index for index in range(total - 1, -1, -1) if self.started - index * 600 >= viewed_after]
+        end = len(indexes) if size is None else min(start + size, len(indexes))
+        entries = []
+        for index in indexes[start:end]:
+            section_key, item_type = (1, 'movie') if index % 2 == 0 else (2, 'episode')
+            item = self.item(section_key, item_type, index // 2)
+            entries.append(item[:-2] + ' {}/>'.format(_attrs(
+                historyKey='/status/sessions/history/{}'.format(index + 1),
+                viewedAt=self.started - index * 600,
+                accountID=index % 25 + 1,
+                deviceID=index % 10 + 1,
+            )))
+        return '<MediaContainer {}>{}</MediaContainer>'.format(
+            _attrs(size=max(end - start, 0), totalSize=len(indexes), offset=start), ''.join(entries)
+        )
+
+    @staticmethod
+    def accounts() -> str:
+        accounts = ''.join('<Account id="{0}" key="/accounts/{0}" name="user{0}"/>'.format(i) for i in range(1, 26))
+        return '<MediaContainer size="25">{}</MediaContainer>'.format(accounts)
+
+    @staticmethod
+    def devices() -> str:
+        devices = ''.join(
+            '<Device id="{0}" name="Device {0}" platform="{1}" clientIdentifier="device-{0}" createdAt="0"/>'.format(
+                i, PLATFORMS[i % len(PLATFORMS)]
+            ) for i in range(1, 11)
+        )
+        return '<MediaContainer size="10">{}</MediaContainer>'.format(devices)
+
+    def respond(self, url: str, headers) -> Optional[str]:
+        """
+        Build the XML response for a request
+        :param url: Request path and query
+        :param headers: Request headers
+        :return: XML or None if the path isn't known
+        """
+        parsed = urlparse(url)
+        path = parsed.path.rstrip('/') or '/'
+        query = {key: values[-1] for key, values in parse_qs(parsed.query).items()}
+
+        # plexapi sends the container window as headers or query parameters depending on the call
+        start = int(headers.get('X-Plex-Container-Start') or query.get('X-Plex-Container-Start') or 0)
+        size = headers.get('X-Plex-Container-Size') or query.get('X-Plex-Container-Size')
+        size = int(size) if size is not None else None
+
+        if path == '/':
+            return self.root()
+        if path == '/library':
+            return self.library()
+        if path == '/library/sections':
+            return self.sections()
+        if path == '/library/recentlyAdded':
+            return self.recently_added(start, size)
+        if path == '/status/sessions':
+            return self.sessions()
+        if path == '/status/sessions/history/all':
+            return self.history(query, start, size)
+        if path == '/accounts':
+            return self.accounts()
+        if path == '/devices':
+            return self.devices()
+        if path == '/statistics/resources':
+            return self.resources()
+        if path == '/statistics/bandwidth':
+            return self.bandwidth(query)
+
+        parts = path.strip('/').split('/')
+        if len(parts) == 4 and parts[:2] == ['library', 'sections'] and parts[2].isdigit():
+            section_key = int(parts[2])
+            if section_key not in SECTIONS:
+                return None
+            if parts[3] == 'all':
+                return self.section_items(section_key, query, start, size)
+            if parts[3] == 'collections':
+                meta = self.meta(section_key) if query.get('includeMeta') == '1' else ''
+                return '<MediaContainer size="0" totalSize="0">{}</MediaContainer>'.format(meta)
+        return None
+
+
+class FakePlexHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server: 'FakePlexHTTPServer'
+
+    def do_GET(self):
+        plex = self.server.plex
+        if self.path == '/__counters__':
+            self._send(200, json.dumps(plex.counters()).encode('utf-8'), 'application/json')
+            return
+
+        body = plex.fixture(urlparse(self.path).path)
+        if body is None:
+            xml = plex.respond(self.path, self.headers)
+            body = xml.encode('utf-8') if xml is not None else None
+
+        if body is None:
+            self._send(404, b'', 'text/plain')
+        else:
+            self._send(200, body, 'text/xml;charset=utf-8')
+        plex.record(urlparse(self.path).path, len(body or b''))
+
+    def _send(self, status: int, body: bytes, content_type: str):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakePlexHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: str, port: int, plex: FakePlex):
+        super().__init__((address, port), FakePlexHandler)
+        self.plex = plex
+
+
+def serve(addresses: List[str], port: int, streams: int, library_size: int, fixtures: str = None, ready=None):
+    """
+    Serve a fake Plex server on each address until interrupted
+    :param addresses: Addresses to listen on, one server each
+    :param port: Port shared by all servers
+    :param streams: Active sessions per server
+    :param library_size: Leaf items (movies, episodes, tracks) in each library
+    :param fixtures: Directory of recorded responses
+    :param ready: Event set once every server is listening
+    :return:
+    """
+    servers = [
+        FakePlexHTTPServer(address, port, FakePlex('bench{}'.format(i + 1), streams, library_size, fixtures))
+        for i, address in enumerate(addresses)
+    ]
+    for server in servers[1:]:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    if ready is not None:
+        ready.set()
+    servers[0].serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve fake Plex servers with synthetic data')
+    parser.add_argument('--servers', type=int, default=1, help='Number of servers, on 127.0.0.1, 127.0.0.2, ...')
+    parser.add_argument('--port', type=int, default=32400)
+    parser.add_argument('--streams', type=int, default=10, help='Active sessions per server')
+    parser.add_argument('--library-size', type=int, default=1000, help='Items in each library')
+    parser.add_argument('--fixtures', help='Directory of recorded XML responses')
+    args = parser.parse_args()
+
+    addresses = ['127.0.0.{}'.format(i + 1) for i in range(args.servers)]
+    print('Serving {} fake Plex servers on port {}'.format(len(addresses), args.port))
+    serve(addresses, args.port, args.streams, args.library_size, args.fixtures)
+
+
+if __name__ == '__main__':
+    main()
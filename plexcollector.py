@@ -1,10 +1,22 @@
 import argparse
+from datetime import datetime
 
 from plexcollector.PlexInfluxdbCollector import PlexInfluxdbCollector
+from plexcollector.config import config
 
 parser = argparse.ArgumentParser(description="A tool to send Plex statistics to InfluxDB")
 parser.add_argument('--singlerun', action='store_true', help='Only runs through once, does not keep monitoring')
+parser.add_argument('--backfill-since', type=datetime.fromisoformat, metavar='DATE',
+                    help='Write the watch history viewed since DATE (e.g. 2020-01-31) and exit')
+parser.add_argument('--shard-index', type=int, help='Index of this instance when servers are split between '
+                                                     'several, from 0 to shard count - 1')
+parser.add_argument('--shard-count', type=int, help='Number of instances the servers are split between')
 args = parser.parse_args()
-collector = PlexInfluxdbCollector(single_run=args.singlerun)
+if args.shard_index is not None or args.shard_count is not None:
+    config.set_shard(
+        config.shard_index if args.shard_index is None else args.shard_index,
+        config.shard_count if args.shard_count is None else args.shard_count
+    )
+collector = PlexInfluxdbCollector(single_run=args.singlerun, backfill_since=args.backfill_since)
 collector.run()
 
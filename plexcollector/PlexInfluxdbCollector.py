@@ -1,124 +1,567 @@
-import base64
-import dataclasses
-import json
+import logging
+import signal
 import sys
+import threading
 import time
-from typing import List, Dict
-from urllib.error import HTTPError
-from urllib.request import Request, urlopen
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from dataclasses import replace
+from datetime import datetime
+from functools import partial
+from typing import List, Dict, Callable, Any, Optional, Tuple
+from urllib.parse import urlparse
 
 import plexapi.base
 import plexapi.library
+import plexapi.utils
 import requests
 import urllib3.exceptions
-from influxdb import InfluxDBClient
-from influxdb.exceptions import InfluxDBClientError, InfluxDBServerError
-from plexapi.server import PlexServer
-from requests import ConnectTimeout
+from plexapi.exceptions import Unauthorized
+from plexapi.server import PlexServer, SystemAccount, SystemDevice
 
 from plexcollector.common import log
+from plexcollector.common.adaptive import AdaptiveInterval
+from plexcollector.common.lineprotocol import encode_points
+from plexcollector.common.pointbuffer import PointBuffer
+from plexcollector.common.rollups import Rollups
+from plexcollector.common.scheduler import Scheduler
+from plexcollector.common.seenset import SeenSet
+from plexcollector.common.sessionevents import SessionTracker
+from plexcollector.common.sessionstore import create_session_store
+from plexcollector.common.sharding import shard_addresses, ShardCoordinator
+from plexcollector.common.spool import Spool, SpoolDrainer
+from plexcollector.common.statefiles import read_json, write_json
+from plexcollector.common.stats import stats, start_metrics_server
+from plexcollector.common.writers import create_writer, InfluxWriteError, InfluxRejectedError
 from plexcollector.common.sctructures import StreamData, MEDIA_TYPES, \
-    MEDIA_TYPE
+    MEDIA_TYPE, LIBRARY_CHILD_TYPES, NOW_PLAYING_VOLATILE_FIELDS, ACTIVE_STREAMS_FIELDS, LibraryScan, get_session_id
 from plexcollector.config import config
-
+from plexcollector.config.configmanager import ServerConfig, COLLECTOR_INTERVALS
 
 # TODO - Update readme for PMS SSL
 class PlexInfluxdbCollector:
-    def __init__(self, single_run=False):
-        self.server_addresses = config.plex_server_addresses
-        self.plex_servers: List[PlexServer] = []
+    def __init__(self, single_run=False, backfill_since: Optional[datetime] = None):
+        # Configured servers of this shard by name.  Accounts whose servers are discovered are kept apart
+        self.static_servers = self._shard_servers(
+            {name: settings for name, settings in config.plex_servers.items() if not settings.discover}
+        )
+        self.discover_accounts = [settings for settings in config.plex_servers.values() if settings.discover]
+        self._discovered: Dict[str, Dict[str, ServerConfig]] = {}  # Account name -> servers found on it
+        self.server_configs: Dict[str, ServerConfig] = dict(self.static_servers)  # Configured and discovered
+        self.plex_servers: List[PlexServer] = []  # Connected servers, replaced rather than modified in place
+        self._connected: Dict[str, PlexServer] = {}  # Name -> server
+        self.server_settings: Dict[PlexServer, ServerConfig] = {}  # Settings each server was connected with
+        self._servers_lock = threading.Lock()
+        self.collector_intervals = self._collector_intervals()
+        self._next_poll: Dict[tuple, float] = {}  # (host, collector) -> when a server with a longer interval is due
+        self._session_intervals: Dict[str, AdaptiveInterval] = {}  # Adaptive session poll interval per host
         self.logger = log
-        self.token = None
+        self.tokens: Dict[str, str] = {}  # Username -> plex.tv auth token
+        self._token_lock = threading.Lock()
         self.single_run = single_run
-        self.active_streams = {}  # Store active streams so we can track duration
+        self.backfill_since = backfill_since
+        # Store active streams so we can track duration
+        self.active_streams = create_session_store(config.session_store, config.state_file, config.session_expiry)
+        self.library_cache: Dict[tuple, LibraryScan] = {}  # Last counts per (host, section key)
+        self.recently_added_seen = SeenSet(
+            config.recently_added_seen_size,
+            config.state_file('recently_added.json')
+        )
+        # Newest written history entry per host: viewed_at and the history keys viewed at that second
+        self.history_written: Dict[str, dict] = read_json(config.state_file('history.json'), default={})
+        self._history_lock = threading.Lock()
+        # Hosts whose history is being ingested.  An ingest outlives the server timeout while catching up
+        self._history_ingesting = set()
+        self.history_names: Dict[str, Dict[str, Dict[int, str]]] = {}  # Host -> account and device names by ID
+        # Time of the newest written server resources and bandwidth samples per host
+        self.server_resources_written: Dict[str, Dict[str, float]] = read_json(
+            config.state_file('server_resources.json'), default={}
+        )
+        self.shard_coordinator = None
+        if config.shard_count > 1:
+            self._setup_shard()
         self.delay = config.delay
-        self.influx_client = self._get_influx_connection()
+        self.influx_writer = create_writer(config)
+        self._influx_settings = config.influx_settings()  # What influx_writer was built from
+        self.spool = None
+        if config.influx_spool and config.state_file('spool'):
+            self.spool = Spool(
+                config.state_file('spool'),
+                config.influx_spool_max_size * 1024 * 1024,
+                config.influx_spool_max_age
+            )
+        self.point_buffer = PointBuffer(config.influx_batch_size)
+        self._write_lock = threading.Lock()
+        # One pool per stage so jobs never queue behind each other
+        self.poll_executors: Dict[str, ThreadPoolExecutor] = {}
+        self.session_trackers: Dict[str, SessionTracker] = {}  # Websocket session state per host
+        self._last_session_reconcile = 0
+        self._streams_lock = threading.Lock()
+        self._stream_data: Dict[str, StreamData] = {}  # Reused for every poll of a session
+        self._host_totals: Dict[str, dict] = {}  # Latest active_streams fields per host, summed for All
+        self.rollups = Rollups(config.rollup_intervals, config.session_expiry)
 
-        # Prevents console spam if verify ssl is disabled
-        if not config.plex_verify_ssl:
+        for verify in (True, False):
+            config.http_session_for(verify).hooks['response'].append(self._record_request)
+
+        self._disable_ssl_warnings()
+
+        self._reload_lock = threading.Lock()
+        self.scheduler = Scheduler()
+        self.exit_code = 0  # Set when a job hits an error the collector can't recover from
+        self._schedule_jobs()
+
+    @staticmethod
+    def _disable_ssl_warnings():
+        """
+        Prevents console spam if verify ssl is disabled for any server
+        """
+        if not all(settings.verify_ssl for settings in config.plex_servers.values()):
             urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
-        self._build_server_list()
+    def _setup_shard(self):
+        """
+        Log which servers this shard polls and coordinate with the other shards when they share a directory
+        :return:
+        """
+        configured = [settings for settings in config.plex_servers.values() if not settings.discover]
+        log.info('Shard {} of {} polling {} of {} configured servers: {}'.format(
+            config.shard_index, config.shard_count, len(self.static_servers),
+            len(configured), ', '.join(self.static_servers)
+        ))
+        if not self.static_servers and not self.discover_accounts:
+            log.warning('No servers are assigned to shard {}'.format(config.shard_index))
+        stats.tags['shard'] = str(config.shard_index)
+
+        shared_file = config.shared_file('shards.db')
+        if shared_file:
+            self.shard_coordinator = ShardCoordinator(shared_file, config.shard_index, config.lease_ttl)
+        elif config.report_combined:
+            log.warning('Combined totals are not reported when sharded without a SharedDir')
 
-    def _build_server_list(self):
+    @staticmethod
+    def _shard_servers(servers: Dict[str, ServerConfig]) -> Dict[str, ServerConfig]:
         """
-        Build a list of plexapi objects from the servers provided in the config
+        Keep the servers polled by this shard
+        :param servers: Servers by name
         :return:
         """
-        for server in self.server_addresses:
-            base_url = config.url(server)
-            session = requests.Session()
-            session.verify = config.plex_verify_ssl
-            api_conn = PlexServer(
-                base_url,
-                self.get_auth_token(
-                    config.plex_user, config.plex_password
-                ),
-                # session=session
-            )
-            self.plex_servers.append(api_conn)
+        names = shard_addresses(list(servers), config.shard_index, config.shard_count)
+        return {name: servers[name] for name in names}
 
     @staticmethod
-    def _get_influx_connection():
+    def _collector_intervals() -> Dict[str, int]:
         """
-        Create an InfluxDB connection and test to make sure it works.
-        We test with the get all users command.  If the address is bad it fails
-        with a 404.  If the user doesn't have permission it fails with 401
+        Interval of each collector's job, the shortest interval of any server it is enabled on.  Collectors
+        enabled on no server are left out
         :return:
         """
-        # TODO - Check what permissions are actually needed to make this work
-        influx = InfluxDBClient(
-            host=config.influx_address,
-            port=config.influx_port,
-            database=config.influx_database,
-            ssl=config.influx_ssl,
-            verify_ssl=config.influx_verify_ssl,
-            username=config.influx_user,
-            password=config.influx_password,
-            timeout=5
-        )
+        intervals = {}
+        for collector in COLLECTOR_INTERVALS:
+            enabled = [
+                settings.intervals[collector] for settings in config.plex_servers.values()
+                if settings.enabled(collector)
+            ]
+            if enabled:
+                intervals[collector] = min(enabled)
+        if 'sessions' in intervals and config.adaptive_sessions and not config.realtime_sessions:
+            intervals['sessions'] = min(intervals['sessions'], config.session_min_delay)
+        return intervals
+
+    def _jobs(self) -> Dict[str, Tuple[Callable[[], None], float]]:
+        """
+        Jobs wanted with the current config
+        :return: Dict of job name to its function and interval
+        """
+        jobs = {'connect': (self.connect_servers, config.reconnect_delay)}
+        if self.discover_accounts:
+            jobs['discover'] = (self.discover_servers, config.discover_delay)
+        collectors = {
+            'sessions': self.get_active_streams,
+            'recently_added': self.get_recently_added,
+            'libraries': self.get_library_data,
+            'history': self.get_history,
+            'server_resources': self.get_server_resources,
+        }
+        for name, func in collectors.items():
+            if name in self.collector_intervals:
+                jobs[name] = (self._flushing(func), self.collector_intervals[name])
+        if config.influx_flush_interval > 0:
+            jobs['flush'] = (self.flush_influx_data, config.influx_flush_interval)
+        jobs['session_snapshot'] = (self.active_streams.snapshot, config.session_snapshot_interval)
+        for interval in config.rollup_intervals:
+            jobs['rollups_{}'.format(interval)] = (self._flushing(partial(self.write_rollups, interval)), interval)
+        if config.stats_interval > 0:
+            jobs['stats'] = (self._flushing(self.get_collector_stats), config.stats_interval)
+        if config.config_reload_delay > 0:
+            jobs['config_reload'] = (self.check_config, config.config_reload_delay)
+        return jobs
+
+    def _schedule_jobs(self):
+        """
+        Register each collector with the scheduler on its own interval.  After the config is reloaded jobs that
+        aren't wanted anymore are removed, new ones added and the intervals of the others updated
+        :return:
+        """
+        jobs = self._jobs()
+        for name in list(self.scheduler.jobs):
+            if name not in jobs:
+                self.scheduler.remove_job(name)
+        for name, (func, interval) in jobs.items():
+            job = self.scheduler.jobs.get(name)
+            if job is None:
+                self.scheduler.add_job(name, func, interval)
+            elif job.interval != interval:
+                self.scheduler.reschedule(name, interval)
+
+    def _flushing(self, func):
+        """
+        Wrap a collector so buffered points are written once it finishes, unless a flush interval is set
+        """
+        def job():
+            func()
+            if config.influx_flush_interval <= 0:
+                self.flush_influx_data()
+        return job
+
+    def connect_servers(self):
+        """
+        Connect to every server that isn't connected yet, in parallel.  Servers that can't be reached are
+        retried on the next run of the connect job
+        :return:
+        """
+        with self._servers_lock:
+            pending = [settings for name, settings in self.server_configs.items() if name not in self._connected]
+        if not pending:
+            return
+
+        # Sign in to each account once rather than from every connection attempt
+        accounts = {(settings.username, settings.password) for settings in pending if not settings.token}
+        for username, password in accounts:
+            self._get_token(username, password)
+
+        with ThreadPoolExecutor(max_workers=config.poll_workers, thread_name_prefix='connect') as executor:
+            results = list(zip(pending, executor.map(self._connect_server, pending)))
+
+        connected = []
+        with self._servers_lock:
+            for settings, server in results:
+                # Skip servers removed or changed while connecting
+                if server is None or self.server_configs.get(settings.name) != settings:
+                    continue
+                self._connected[settings.name] = server
+                self.server_settings[server] = settings
+                connected.append(server)
+            if not connected:
+                return
+            self.plex_servers = self.plex_servers + connected
+
+        log.info('Connected to {} of {} servers'.format(len(self._connected), len(self.server_configs)))
+        # Collect from the new servers right away instead of waiting for the next interval
+        self.scheduler.trigger('recently_added')
+        self.scheduler.trigger('libraries')
+
+    def _connect_server(self, settings: ServerConfig) -> Optional[PlexServer]:
+        token = settings.token or self.tokens.get(settings.username)
+        if not token:
+            return None
+
+        session = config.http_session_for(settings.verify_ssl)
+        for base_url in (settings.url,) + settings.alternate_urls:
+            try:
+                return PlexServer(base_url, token, session=session, timeout=config.server_timeout)
+            except Unauthorized:
+                if settings.token:
+                    log.error('Server %s rejected the token of %s', base_url, settings.name)
+                else:
+                    log.error('Server %s rejected the auth token, signing in again on the next attempt', base_url)
+                    self._invalidate_token(settings.username)
+                return None
+            except Exception as e:
+                log.error('Unable to connect to %s, retrying in %ss: %s', base_url, config.reconnect_delay, e)
+        return None
+
+    def _update_servers(self, servers: Dict[str, ServerConfig]):
+        """
+        Replace the servers collected from.  Servers that were removed or need a new connection are
+        disconnected, new servers are connected by the connect job which is started right away.  Servers whose
+        connection settings didn't change keep their connection and only pick up their new settings
+        :param servers: Servers by name
+        :return:
+        """
+        removed_hosts = []
+        with self._servers_lock:
+            for name, settings in self.server_configs.items():
+                new_settings = servers.get(name)
+                server = self._connected.get(name)
+                if new_settings is not None and settings.same_connection(new_settings):
+                    if server is not None:
+                        self.server_settings[server] = new_settings
+                    continue
+                if server is not None:
+                    self._disconnect_server(name)
+                    if new_settings is None:
+                        removed_hosts.append(server._baseurl)
+                log.info('%s Plex server %s', 'Removed' if new_settings is None else 'Updated', name)
+
+            added = [name for name in servers if name not in self.server_configs]
+            for name in added:
+                log.info('Added Plex server %s', name)
+            self.server_configs = servers
+
+        if removed_hosts:
+            # Sessions of removed servers won't be seen again
+            with self._streams_lock:
+                self._remove_dead_streams(removed_hosts, [])
+        if len(self._connected) < len(servers):
+            self.scheduler.trigger('connect')
+
+    def _disconnect_server(self, name: str):
+        """
+        Stop collecting from a connected server.  Must be called holding the servers lock
+        :param name: Server name
+        :return:
+        """
+        server = self._connected.pop(name)
+        self.plex_servers = [connected for connected in self.plex_servers if connected is not server]
+        self.server_settings.pop(server, None)
+        host = server._baseurl
+        tracker = self.session_trackers.pop(host, None)
+        if tracker is not None:
+            tracker.stop()
+        self._host_totals.pop(host, None)
+        self._session_intervals.pop(host, None)
+        log.info('Disconnected from %s', host)
+
+    def discover_servers(self):
+        """
+        Find the servers of every account with Discover enabled with the plex.tv resources API.  Servers that
+        appeared are connected and servers that are gone are dropped.  An account that can't be reached keeps the
+        servers found last time
+        :return:
+        """
+        for account in self.discover_accounts:
+            found = self._discover_account(account)
+            if found is not None:
+                self._discovered[account.name] = found
+
+        self._update_servers(self._all_servers())
+
+    def _all_servers(self) -> Dict[str, ServerConfig]:
+        """
+        Configured servers of this shard and the servers found by discovery
+        """
+        servers = dict(self.static_servers)
+        for found in self._discovered.values():
+            servers.update(found)
+        return servers
+
+    def _discover_account(self, account: ServerConfig) -> Optional[Dict[str, ServerConfig]]:
+        """
+        Servers owned by a plex.tv account, with the settings of the account
+        :param account: Account settings
+        :return: Servers of this shard by name, or None if plex.tv couldn't be reached
+        """
+        token = account.token or self._get_token(account.username, account.password)
+        if not token:
+            return None
+
+        headers = dict(self._default_headers)
+        headers.update({'X-Plex-Token': token, 'Accept': 'application/json'})
+        try:
+            r = config.http_session.get(
+                'https://clients.plex.tv/api/v2/resources',
+                params={'includeHttps': 1, 'includeRelay': 0},
+                headers=headers
+            )
+            r.raise_for_status()
+            resources = r.json()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            response = getattr(e, 'response', None)
+            if response is not None and response.status_code == 401 and not account.token:
+                self._invalidate_token(account.username)
+            log.error('Failed to discover the servers of %s, retrying in %ss: %s',
+                      account.name, config.discover_delay, e)
+            return None
+
+        servers = {}
+        for resource in resources:
+            if 'server' not in resource.get('provides', '').split(',') or not resource.get('owned'):
+                continue
+            # Local connections first, they're the fastest when the collector runs next to the server
+            urls = [
+                connection['uri'] for connection in
+                sorted(resource.get('connections') or [], key=lambda connection: not connection.get('local'))
+            ]
+            if not urls:
+                continue
+            name = '{}/{}'.format(account.name, resource['name'])
+            servers[name] = replace(
+                account,
+                name=name,
+                url=urls[0],
+                alternate_urls=tuple(urls[1:]),
+                token=resource.get('accessToken') or token,
+                discover=False
+            )
+
+        log.info('Discovered {} servers on {}'.format(len(servers), account.name))
+        return self._shard_servers(servers)
+
+    def check_config(self):
+        """
+        Reload the config if the file was modified since it was loaded
+        :return:
+        """
+        if config.changed():
+            self.reload_config()
+
+    def reload_config(self):
+        """
+        Load the config again and apply what changed without restarting.  Servers that were added or removed are
+        connected or dropped, intervals, the log level and the InfluxDB target are updated.  Active sessions and
+        unchanged server connections are kept
+        :return:
+        """
+        with self._reload_lock:
+            ignored = config.reload()
+            if ignored is None:
+                log.error('Unable to reload %s, keeping the current config', config.config_file)
+                return
+            log.info('Reloaded %s', config.config_file)
+            if ignored:
+                log.warning('Changes to %s only take effect on restart', ', '.join(ignored))
+
+            log.setLevel(config.logging_level)
+            self._disable_ssl_warnings()
+            self.point_buffer.batch_size = max(config.influx_batch_size, 1)
+            self.rollups.set_intervals(config.rollup_intervals)
+            if not config.realtime_sessions:
+                trackers, self.session_trackers = self.session_trackers, {}
+                for tracker in trackers.values():
+                    tracker.stop()
+
+            self.static_servers = self._shard_servers(
+                {name: settings for name, settings in config.plex_servers.items() if not settings.discover}
+            )
+            accounts = [settings for settings in config.plex_servers.values() if settings.discover]
+            accounts_changed = accounts != self.discover_accounts
+            self.discover_accounts = accounts
+            self._discovered = {
+                name: found for name, found in self._discovered.items()
+                if name in {account.name for account in accounts}
+            }
+            self.collector_intervals = self._collector_intervals()
+            if not config.adaptive_sessions:
+                # Poll every server on the next tick instead of waiting out its adaptive interval
+                self._session_intervals = {}
+                for key in [key for key in self._next_poll if key[1] == 'sessions']:
+                    del self._next_poll[key]
+            self._schedule_jobs()
+
+            if accounts_changed:
+                # Discovered servers take the settings of their account
+                self.discover_servers()
+            else:
+                self._update_servers(self._all_servers())
+
+            # Last, so a target that can't be reached doesn't hold back the other changes
+            self._reload_influx_writer()
+
+    def _reload_influx_writer(self):
+        """
+        Switch to a new InfluxDB target if its settings changed.  Points collected so far are written to the old
+        one first
+        :return:
+        """
+        settings = config.influx_settings()
+        if settings == self._influx_settings:
+            return
+
+        self.flush_influx_data()
         try:
-            log.debug('Testing connection to InfluxDb using provided credentials')
-            influx.get_list_users()  # TODO - Find better way to test connection and permissions
-            log.debug('Successful connection to InfluxDb')
-        except (ConnectTimeout, InfluxDBClientError) as e:
-            if isinstance(e, ConnectTimeout):
-                log.critical('Unable to connect to InfluxDB at the provided address (%s)', config.influx_address)
-            elif e.code == 401:
-                log.critical('Unable to connect to InfluxDB with provided credentials')
+            writer = create_writer(config)
+        except (Exception, SystemExit) as e:
+            # The writer exits when it can't connect, a running collector keeps going
+            log.error('Keeping the current InfluxDB target, the new one can\'t be used: %s', e)
+            return
+        with self._write_lock:
+            self.influx_writer = writer
+        self._influx_settings = settings
+        log.info('Writing to InfluxDB at %s', config.influx_address)
 
-            sys.exit(1)
+    def _on_sighup(self, signum, frame):
+        threading.Thread(target=self.reload_config, name='config-reload', daemon=True).start()
 
-        return influx
+    def _get_token(self, username: str, password: str) -> Optional[str]:
+        """
+        Get the auth token of an account, from the token cache if it hasn't expired, otherwise by signing in to
+        plex.tv
+        :param username: Plex Username
+        :param password: Plex Password
+        :return: str or None if plex.tv couldn't be reached
+        """
+        with self._token_lock:
+            if self.tokens.get(username):
+                return self.tokens[username]
+
+            token_file = config.state_file('token.json')
+            cached = self._read_token_cache(token_file)
+            entry = cached.get(username, {})
+            if entry.get('token') and time.time() - entry.get('fetched_at', 0) < config.token_cache_ttl:
+                log.debug('Using cached auth token')
+                self.tokens[username] = entry['token']
+                return entry['token']
+
+            token = self.get_auth_token(username, password)
+            if token:
+                self.tokens[username] = token
+                if token_file:
+                    cached[username] = {'token': token, 'fetched_at': time.time()}
+                    write_json(token_file, cached)
+            return token
+
+    def _invalidate_token(self, username: str):
+        with self._token_lock:
+            self.tokens.pop(username, None)
+            token_file = config.state_file('token.json')
+            cached = self._read_token_cache(token_file)
+            if cached.pop(username, None) is not None:
+                write_json(token_file, cached)
+
+    @staticmethod
+    def _read_token_cache(token_file: Optional[str]) -> Dict[str, dict]:
+        cached = read_json(token_file, default={})
+        if 'username' in cached:
+            # Written by versions that only signed in to one account
+            cached = {cached['username']: cached}
+        return cached
 
     def get_auth_token(self, username, password):
         """
         Make a reqest to plex.tv to get an authentication token for future requests
         :param username: Plex Username
         :param password: Plex Password
-        :return: str
+        :return: str or None if plex.tv couldn't be reached
         """
 
         log.info('Getting Auth Token For User {}'.format(username))
 
-        auth_string = '{}:{}'.format(username, password)
-        base_auth = base64.encodebytes(bytes(auth_string, 'utf-8'))
-        req = self.request('https://plex.tv/users/sign_in.json')
-        req.add_header('Authorization', f'Basic {base_auth[:-1].decode("utf-8")}')
-
         try:
-            result = urlopen(req, data=b'').read()
-        except HTTPError as e:
-            print('Failed To Get Authentication Token')
-            if e.code == 401:
-                log.error('Failed to get token due to bad username/password')
-            else:
-                print('Maybe this will help:')
-                print(e)
-                log.error('Failed to get authentication token.  No idea why')
-            sys.exit(1)
+            r = config.http_session.post(
+                'https://plex.tv/users/sign_in.json',
+                auth=(username, password),
+                headers=self._default_headers
+            )
+            r.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            if e.response is not None and e.response.status_code == 401:
+                log.critical('Failed to get token due to bad username/password')
+                self.stop(1)
+                return None
+            log.error('Failed to get authentication token, retrying in %ss: %s', config.reconnect_delay, e)
+            return None
 
-        output = json.loads(result.decode('utf-8'))
+        output = r.json()
 
         # Make sure we actually got a token back
         if 'authToken' in output['user']:
@@ -126,34 +569,240 @@ class PlexInfluxdbCollector:
             return output['user']['authToken']
         else:
             print('Something Broke \n We got a valid response but for some reason there\'s no auth token')
-            sys.exit(1)
+            self.stop(1)
+            return None
 
-    def request(self, url: str) -> Request:
+    def stop(self, exit_code: int = 0):
         """
-        Make a request to plex.tv
+        Stop the monitoring loop.  Jobs run in their own threads where sys.exit would only end the job, so the
+        exit code is checked from the main thread once the loop stops
+        :param exit_code: Code the process exits with
+        :return:
         """
-        return Request(url, headers=self._default_headers)
+        self.exit_code = exit_code
+        self.scheduler.stop()
 
     @property
     def _default_headers(self):
-        headers = {
+        return {
             'X-Plex-Client-Identifier': 'Plex InfluxDB Collector',
             'X-Plex-Product': 'Plex InfluxDB Collector',
             'X-Plex-Version': '1',
         }
-        if self.token:
-            headers['X-Plex-Token'] = self.token
-        return headers
+
+    def _poll_servers(
+            self,
+            func: Callable[[PlexServer], Any],
+            stage: str,
+            servers: List[PlexServer] = None
+    ) -> Dict[PlexServer, Any]:
+        """
+        Run func against every server in parallel on the stage's poll executor.  A server that raises or takes
+        longer than the configured server timeout is recorded as a failed poll and left out of the result
+        :param func: Callable taking a PlexServer
+        :param stage: Name of what is being polled, used for logging
+        :param servers: Servers to poll, defaults to all servers
+        :return: Dict of server to the value returned by func
+        """
+        started = {}
+
+        def timed(server):
+            started[server] = time.monotonic()
+            with stats.timer(stage, server._baseurl):
+                return func(server)
+
+        if stage not in self.poll_executors:
+            self.poll_executors[stage] = ThreadPoolExecutor(
+                max_workers=config.poll_workers, thread_name_prefix='poll-{}'.format(stage.replace(' ', '_'))
+            )
+        executor = self.poll_executors[stage]
+
+        if servers is None:
+            servers = self.plex_servers
+
+        futures = {executor.submit(timed, server): server for server in servers}
+        pending = set(futures)
+        results = {}
+
+        while pending:
+            done, pending = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+            for future in done:
+                server = futures[future]
+                try:
+                    results[server] = future.result()
+                except Exception as e:
+                    self._record_failed_poll(server, stage, e)
+
+            now = time.monotonic()
+            for future in list(pending):
+                server = futures[future]
+                if server in started and now - started[server] > config.server_timeout:
+                    pending.discard(future)
+                    self._record_failed_poll(server, stage, 'Timed out after {}s'.format(config.server_timeout))
+
+        return results
+
+    def _servers_with(self, collector: str) -> List[PlexServer]:
+        """
+        Connected servers a collector is enabled on
+        """
+        servers = []
+        for server in self.plex_servers:
+            settings = self.server_settings.get(server)
+            if settings is not None and settings.enabled(collector):
+                servers.append(server)
+        return servers
+
+    def _due_servers(self, collector: str) -> List[PlexServer]:
+        """
+        Connected servers to run a collector on now.  The collector's job runs on the shortest interval of any
+        server, servers with a longer interval of their own are skipped until it has passed
+        """
+        job_interval = self.collector_intervals.get(collector, 0)
+        now = time.monotonic()
+        due = []
+        for server in self._servers_with(collector):
+            key = (server._baseurl, collector)
+            if now < self._next_poll.get(key, 0):
+                continue
+            interval = self.server_settings[server].intervals[collector]
+            if interval > job_interval:
+                # Half a job interval early so scheduling jitter doesn't push the server back a whole interval
+                self._next_poll[key] = now + interval - job_interval / 2
+            due.append(server)
+        return due
+
+    @staticmethod
+    def _record_failed_poll(server: PlexServer, stage: str, reason):
+        stats.incr('failed_polls', host=server._baseurl)
+        log.error('Failed to poll %s from %s: %s', stage, server._baseurl, reason)
 
     def get_active_streams(self):
-        log.info('Attempting to get active sessions')
+        servers = []
+        if config.realtime_sessions:
+            log.info('Attempting to get active sessions')
+            active_streams = self._get_tracked_streams()
+        else:
+            servers = self._due_servers('sessions')
+            if not servers:
+                # The job ticks faster than any one server is polled when some have longer or adaptive intervals
+                return
+            log.info('Attempting to get active sessions')
+            latencies = {}
 
-        active_streams = {
-            server._baseurl: server.sessions()
-            for server in self.plex_servers
-        }
+            def poll(server):
+                start = time.monotonic()
+                try:
+                    return server.sessions()
+                finally:
+                    latencies[server] = time.monotonic() - start
+
+            polled = self._poll_servers(poll, 'sessions', servers)
+            active_streams = {server._baseurl: sessions for server, sessions in polled.items()}
+            if config.adaptive_sessions:
+                self._adapt_session_intervals(servers, polled, latencies)
+
+        with self._streams_lock:
+            # Servers that failed to be polled are left out of the All totals
+            for server in servers:
+                if server._baseurl not in active_streams:
+                    self._host_totals.pop(server._baseurl, None)
+            self._process_active_streams(active_streams)
 
-        self._process_active_streams(active_streams)
+    def _adapt_session_intervals(
+            self,
+            servers: List[PlexServer],
+            polled: Dict[PlexServer, List[MEDIA_TYPE]],
+            latencies: Dict[PlexServer, float]
+    ):
+        """
+        Schedule the next session poll of each server by how busy and how responsive it was
+        :param servers: Servers that were polled
+        :param polled: Sessions of the servers that were polled successfully
+        :param latencies: Seconds each poll took, polls that timed out are still running
+        :return:
+        """
+        now = time.monotonic()
+        job_interval = self.collector_intervals['sessions']
+        for server in servers:
+            settings = self.server_settings.get(server)
+            if settings is None:
+                continue
+            host = server._baseurl
+            sessions = polled.get(server)
+            signature = None
+            if sessions is not None:
+                signature = frozenset(
+                    (get_session_id(stream, host), getattr(stream.players[0], 'state', '')) for stream in sessions
+                )
+
+            adaptive = self._session_intervals.get(host)
+            if adaptive is None:
+                adaptive = self._session_intervals[host] = AdaptiveInterval()
+            interval = adaptive.update(
+                signature,
+                latencies.get(server, config.server_timeout),
+                settings.intervals['sessions'],
+                config.session_min_delay,
+                config.session_max_delay,
+                config.session_slow_latency
+            )
+            self._next_poll[(host, 'sessions')] = now + interval - job_interval / 2
+            stats.set_gauge('session_poll_interval', interval, host)
+
+    def _get_tracked_streams(self) -> Dict[str, List[MEDIA_TYPE]]:
+        """
+        Get active sessions kept up to date by websocket notifications.  Every session reconcile delay all
+        servers are polled to catch anything the notifications missed.  Servers without a working
+        notification listener are polled every time and their listener restarted
+        :return:
+        """
+        now = time.monotonic()
+        reconcile = now - self._last_session_reconcile >= config.session_reconcile_delay
+        if reconcile:
+            self._last_session_reconcile = now
+
+        servers = self._servers_with('sessions')
+        stale_servers = []
+        for server in servers:
+            tracker = self.session_trackers.get(server._baseurl)
+            if tracker is None:
+                tracker = self.session_trackers[server._baseurl] = SessionTracker(server, self._on_session_change)
+                tracker.start()
+            elif reconcile and not tracker.alive:
+                tracker.start()
+
+            if not tracker.alive:
+                stale_servers.append(server)
+
+        polled = self._poll_servers(
+            lambda server: server.sessions(),
+            'sessions',
+            servers if reconcile else stale_servers
+        )
+        for server, sessions in polled.items():
+            tracker = self.session_trackers.get(server._baseurl)
+            if tracker is not None:
+                tracker.reconcile(sessions)
+
+        return self._tracked_snapshots()
+
+    def _tracked_snapshots(self) -> Dict[str, List[MEDIA_TYPE]]:
+        """
+        Sessions of every notification listener.  Listeners are added and removed from other threads, so the
+        dict is copied before it is iterated
+        """
+        return {host: tracker.snapshot() for host, tracker in list(self.session_trackers.items())}
+
+    def _on_session_change(self, server: PlexServer):
+        """
+        Called from a notification listener when a session starts, stops or changes state
+        """
+        log.debug('Sessions changed on %s', server._baseurl)
+        with self._streams_lock:
+            self._process_active_streams(self._tracked_snapshots())
+        if config.influx_flush_interval <= 0:
+            self.flush_influx_data()
 
     def _process_active_streams(self, stream_data: Dict[str, List[MEDIA_TYPE]]):
         """
@@ -164,65 +813,92 @@ class PlexInfluxdbCollector:
 
         log.info('Processing Active Streams')
 
-        combined_streams = 0
         session_ids = []  # Active Session IDs for this run
 
         for host, streams in stream_data.items():
 
-            combined_streams += len(streams)
-            combined_video_transcodes = 0
-            combined_audio_transcodes = 0
+            host_fields = dict.fromkeys(ACTIVE_STREAMS_FIELDS, 0)
+            host_fields['active_streams'] = len(streams)
 
             for stream in streams:
                 player = stream.players[0]
                 user = stream.usernames[0]
-                session_id = stream.session[0].id
+                session_id = get_session_id(stream, host)
                 session_ids.append(session_id)
 
-                if session_id in self.active_streams:
-                    start_time = self.active_streams[session_id]['start_time']
-                else:
-                    start_time = time.time()
-                    self.active_streams.setdefault(session_id, {})['start_time'] = start_time
-
                 media_type = MEDIA_TYPES.get(stream.type, 'Unknown')
 
-                data, video, audio = StreamData().stream_processor(stream)
+                data = self._stream_data.get(session_id)
+                if data is None:
+                    data = self._stream_data[session_id] = StreamData()
+                data, video, audio = data.stream_processor(stream)
 
                 # playing, paused, buffering
                 player_state = getattr(player, 'state', 'Unavailable')
+                data.player_state = player_state
+
+                details = data.fields()
+                details['player'] = player.title
+                details['user'] = user
+                details['media_type'] = media_type
+                details['platform'] = player.platform
+                details['player_address'] = player.address
+                record = self.active_streams.update(
+                    session_id,
+                    host,
+                    player_state,
+                    transcoding=bool(video or audio),
+                    bandwidth=data.bandwidth,
+                    details=details
+                )
+                start_time = record['start_time']
+                now = time.time()
 
-                combined_video_transcodes += video
-                combined_audio_transcodes += audio
-
-                log.debug(f'Title: {data.full_title}')
-                log.debug(f'Media Type: {media_type}')
-                log.debug(f'Session ID: {session_id}')
-                log.debug(f'Resolution: {data.resolution}')
-                log.debug(f'Duration: {time.time() - start_time}')
-                log.debug(f'Transcode Video: {data.transcode_video}')
-                log.debug(f'Transcode Audio: {data.transcode_audio}')
-                log.debug(f'Container: {data.container}')
-                log.debug(f'Video Codec: {data.video_codec}')
-                log.debug(f'Audio Codec: {data.audio_codec}')
-                log.debug(f'Length ms: {data.length_ms}')
-                log.debug(f'Position: {data.position}')
-                log.debug(f'Pos Percent: {data.pos_percent}')
+                host_fields['video_transcodes'] += video
+                host_fields['audio_transcodes'] += audio
+                if video:
+                    host_fields['hw_transcodes' if data.transcode_hw else 'sw_transcodes'] += 1
+                if data.transcode_throttled:
+                    host_fields['throttled_transcodes'] += 1
+                host_fields['bandwidth'] += data.bandwidth
+                if data.location in ('lan', 'wan'):
+                    host_fields['{}_bandwidth'.format(data.location)] += data.bandwidth
+
+                self.rollups.observe(
+                    session_id,
+                    player_state,
+                    bool(video or audio),
+                    user=user,
+                    title=data.grandparent_title or data.title,
+                    platform=player.platform,
+                    host=host
+                )
+
+                if log.isEnabledFor(logging.DEBUG):
+                    log.debug(
+                        'Title: %s, Media Type: %s, Session ID: %s, Resolution: %s, Duration: %s, '
+                        'Transcode Video: %s, Transcode Audio: %s, Container: %s, Video Codec: %s, '
+                        'Audio Codec: %s, Length ms: %s, Position: %s, Pos Percent: %s',
+                        data.full_title, media_type, session_id, data.resolution, now - start_time,
+                        data.transcode_video, data.transcode_audio, data.container, data.video_codec,
+                        data.audio_codec, data.length_ms, data.position, data.pos_percent
+                    )
+
+                playing_fields = details.copy()
+                del playing_fields['player_address']
+                playing_fields['state'] = player.state
+                playing_fields['duration'] = now - start_time
+                playing_fields['start_time'] = start_time
+                playing_fields['paused_time'] = record['paused_time']
+                playing_fields['transcode_time'] = record['transcode_time']
+                playing_fields['bytes_sent'] = record['bytes']
+                if config.now_playing_delta:
+                    playing_fields = self._delta_fields(record, playing_fields)
 
                 playing_points = [
                     {
                         'measurement': 'now_playing',
-                        'fields': {
-                            'player': player.title,
-                            'state': player.state,
-                            'user': user,
-                            'media_type': media_type,
-                            'duration': time.time() - start_time,
-                            'start_time': start_time,
-                            'platform': player.platform,
-                            'player_state': player_state,
-                            **dataclasses.asdict(data)
-                        },
+                        'fields': playing_fields,
                         'tags': {
                             'host': host,
                             'player_address': player.address,
@@ -233,15 +909,13 @@ class PlexInfluxdbCollector:
 
                 self.write_influx_data(playing_points)
 
+            self._host_totals[host] = host_fields
+
             # Record total streams for this host
             total_stream_points = [
                 {
                     'measurement': 'active_streams',
-                    'fields': {
-                        'active_streams': len(streams),
-                        'video_transcodes': combined_video_transcodes,
-                        'audio_transcodes': combined_audio_transcodes
-                    },
+                    'fields': host_fields,
                     'tags': {
                         'host': host
                     }
@@ -249,14 +923,18 @@ class PlexInfluxdbCollector:
             ]
             self.write_influx_data(total_stream_points)
 
-        # Report total streams across all hosts
+        # Report total streams across all hosts, including the latest totals of servers not polled this time
+        combined_fields = dict.fromkeys(ACTIVE_STREAMS_FIELDS, 0)
+        for host_fields in self._host_totals.values():
+            for key, value in host_fields.items():
+                combined_fields[key] += value
         if config.report_combined:
+            combined_fields = self._combined_totals('active_streams', combined_fields)
+        if config.report_combined and combined_fields is not None:
             combined_stream_points = [
                 {
                     'measurement': 'active_streams',
-                    'fields': {
-                        'active_streams': combined_streams
-                    },
+                    'fields': combined_fields,
                     'tags': {
                         'host': 'All'
                     }
@@ -264,68 +942,193 @@ class PlexInfluxdbCollector:
             ]
 
             self.write_influx_data(combined_stream_points)
-            self._remove_dead_streams(session_ids)
 
-    def _remove_dead_streams(self, current_streams):
+        self._remove_dead_streams(stream_data.keys(), session_ids)
+        self.rollups.count_streams()
+
+    def _combined_totals(self, name: str, fields: Dict[str, float]) -> Optional[Dict[str, float]]:
+        """
+        Totals across every server.  When sharded only the leader reports them, summing what every shard published
+        :param name: Measurement the totals are written to
+        :param fields: Totals of the servers polled by this instance
+        :return: Totals to write, or None if this instance doesn't write them
+        """
+        if config.shard_count <= 1:
+            return fields
+        if self.shard_coordinator is None:
+            return None
+
+        self.shard_coordinator.publish(name, fields)
+        if not self.shard_coordinator.acquire():
+            return None
+        return self.shard_coordinator.combined(name)
+
+    @staticmethod
+    def _delta_fields(record: dict, fields: dict) -> dict:
         """
-        Go through the stored list of active streams and remove any that are no longer active
+        Reduce now_playing fields to the volatile ones unless the session is new, its metadata changed or
+        the full refresh interval has passed
+        :param record: Session record from the session store, remembers what was last written
+        :param fields: All now_playing fields
+        :return: Fields to write
+        """
+        metadata_hash = hash(tuple(sorted(
+            (key, value) for key, value in fields.items() if key not in NOW_PLAYING_VOLATILE_FIELDS
+        )))
+        now = time.time()
+        refresh_due = now - record.get('full_at', 0) >= config.now_playing_full_refresh
+        if refresh_due or record.get('metadata_hash') != metadata_hash:
+            record['metadata_hash'] = metadata_hash
+            record['full_at'] = now
+            return fields
+
+        return {key: fields[key] for key in NOW_PLAYING_VOLATILE_FIELDS if key in fields}
+
+    def _remove_dead_streams(self, hosts, current_streams):
+        """
+        Go through the stored list of active streams and remove any that are no longer active.
+        A session_summary point is written for each ended stream
+        :param hosts: Hosts that were polled, streams of other hosts are kept
         :param current_streams: List of currently active streams from last API call
         :return:
         """
-        remove_keys = []
-        for id, data in self.active_streams.items():
-            if id not in current_streams:
-                remove_keys.append(id)
-        for key in remove_keys:
-            self.active_streams.pop(key)
+        summary_points = []
+        for record in self.active_streams.remove_missing(hosts, current_streams):
+            self._stream_data.pop(record['session_id'], None)
+            self.rollups.end(record['session_id'])
+            log.debug('Session %s ended after %.0fs', record['session_id'], time.time() - record['start_time'])
+            if config.session_summaries:
+                summary_points.append(self._session_summary_point(record))
+
+        if summary_points:
+            self.write_influx_data(summary_points)
+
+    @staticmethod
+    def _session_summary_point(record: dict) -> dict:
+        """
+        Build a session_summary point from the stored record of an ended session
+        :param record: Session record from the session store
+        :return:
+        """
+        fields = dict(record.get('details', {}))
+        player_address = fields.pop('player_address', '')
+        fields.update({
+            'duration': record['last_seen'] - record['start_time'],
+            'start_time': record['start_time'],
+            'paused_time': record['paused_time'],
+            'transcode_time': record['transcode_time'],
+            'bytes_sent': record['bytes'],
+        })
+        for state, seconds in record.get('state_times', {}).items():
+            fields.setdefault('{}_time'.format(state), seconds)
+
+        return {
+            'measurement': 'session_summary',
+            'fields': fields,
+            'tags': {
+                'host': record['host'],
+                'player_address': player_address,
+                'session_id': record['session_id']
+            },
+            'time': int(record['last_seen'] * 1e9)
+        }
 
     def get_library_data(self):
         """
         Get all library data for each provided server.
         """
-        # TODO This might take ages in large libraries.  Add a separate delay for this check
-        lib_data = {}
+        polled = self._poll_servers(self._get_server_library_data, 'libraries', self._due_servers('libraries'))
+        lib_data = {server._baseurl: host_libs for server, host_libs in polled.items()}
 
-        for server in self.plex_servers:
+        self._process_library_data(lib_data)
+
+    def _get_server_library_data(self, server: PlexServer):
+        """
+        Get library data for a single server
+        :param server:
+        :return: List of library dicts
+        """
+        with stats.timer('library_sections', server._baseurl):
             libs: List[plexapi.library.LibrarySection] = server.library.sections()
-            log.info('We found {} libraries for server {}'.format(str(len(libs)), server))
-            host_libs = []
-            for lib in libs:
-                host_lib = {
-                    'tags': {
-                        'lib_name': lib.title,
-                        'lib_type': lib.type,
-                    },
-                    'items': len(lib.search())
-                }
+        log.info('We found {} libraries for server {}'.format(str(len(libs)), server))
+        host_libs = []
+        for lib in libs:
+            cache_key = (server._baseurl, lib.key)
+            watermark = None
+            if config.library_incremental:
+                watermark = self._library_watermark(lib)
+                cached = self.library_cache.get(cache_key)
+                if (
+                    cached is not None
+                    and cached.watermark == watermark
+                    and time.time() - cached.scanned_at < config.library_rescan_delay
+                ):
+                    log.debug('Library %s on %s has not changed, reusing counts', lib.title, server._baseurl)
+                    host_libs.append(cached.data)
+                    continue
 
-                if lib.type == "show":
-                    host_lib['episodes'] = 0
-                    host_lib['seasons'] = 0
-                    shows = lib.search()
-                    for show in shows:
-                        log.debug('Checking TV Show: %s', show.title)
-                        host_lib['episodes'] += len(show.seasons())
-                        host_lib['seasons'] += len(show.episodes())
+            host_lib = {
+                'tags': {
+                    'lib_name': lib.title,
+                    'lib_type': lib.type,
+                },
+            }
+            with stats.timer('library_count', server._baseurl):
+                host_lib['items'] = self._count_library_items(lib)
+                for key, libtype in LIBRARY_CHILD_TYPES.get(lib.type, {}).items():
+                    host_lib[key] = self._count_library_items(lib, libtype)
 
-                host_libs.append(host_lib)
-            lib_data[server] = host_libs
+            if watermark is not None:
+                self.library_cache[cache_key] = LibraryScan(watermark, time.time(), host_lib)
+            host_libs.append(host_lib)
 
-        self._process_library_data(lib_data)
+        return host_libs
 
-    def get_recently_added(self):
+    @staticmethod
+    def _library_watermark(lib: plexapi.library.LibrarySection) -> tuple:
         """
-        Build list of recently added
-        :return:
+        Build a watermark that changes whenever the contents of a library might have changed.
+        Uses the section's updatedAt and scannedAt plus the addedAt of the newest leaf item
+        (episode/track for shows/music) which costs a single one item request
+        :param lib: Library section
+        :return: tuple
         """
+        child_types = list(LIBRARY_CHILD_TYPES.get(lib.type, {}).values())
+        newest = lib.search(sort='addedAt:desc', libtype=child_types[-1] if child_types else None, maxresults=1)
+        newest_added_at = newest[0].addedAt if newest else None
+        # plexapi doesn't parse scannedAt so read it from the raw section XML
+        return lib.updatedAt, lib._data.attrib.get('scannedAt'), newest_added_at
 
-        for server in self.plex_servers:
-            recent_list = []
+    @staticmethod
+    def _count_library_items(lib: plexapi.library.LibrarySection, libtype: str = None) -> int:
+        """
+        Count the items of a type in a library.  In count only mode this asks Plex for the total size of an
+        empty container, so it costs one small request no matter how big the library is
+        :param lib: Library section
+        :param libtype: Type of item to count (season, episode, album, track).  Defaults to the library type
+        :return: int
+        """
+        if config.library_count_only:
+            return lib.totalViewSize(libtype=libtype, includeCollections=False) or 0
 
-            for section in server.library.sections():
-                recent_list += section.recentlyAdded(maxresults=10)
+        log.debug('Searching %s library %s', libtype or lib.type, lib.title)
+        return len(lib.search(libtype=libtype))
+
+    def get_recently_added(self):
+        """
+        Build list of recently added.  Only items that haven't been written before are sent to InfluxDB
+        :return:
+        """
+        polled = self._poll_servers(
+            self._get_server_recently_added, 'recently added', self._due_servers('recently_added')
+        )
+        for server, items in polled.items():
+            points = []
+            for item in items:
+                seen_key = '{}|{}|{}'.format(server._baseurl, item.ratingKey, int(item.addedAt.timestamp()))
+                if not self.recently_added_seen.add(seen_key):
+                    continue
 
-            for item in recent_list:
                 data = {
                     'measurement': 'recently_added',
                     'fields': {
@@ -337,12 +1140,276 @@ class PlexInfluxdbCollector:
                     }
                 }
 
-                if hasattr(item, 'grandparentTitle'):
-                    data['fields']['title'] = item.grandparentTitle + ' - ' + item.title
+                prefix = getattr(item, 'grandparentTitle', None) or getattr(item, 'parentTitle', None)
+                if prefix:
+                    data['fields']['title'] = prefix + ' - ' + item.title
                 else:
                     data['fields']['title'] = item.title
 
-                self.write_influx_data([data])
+                points.append(data)
+
+            log.debug('Found %s new recently added items on %s', len(points), server._baseurl)
+            if points:
+                self.write_influx_data(points)
+
+        self.recently_added_seen.save()
+
+    @staticmethod
+    def _get_server_recently_added(server: PlexServer):
+        """
+        Get the newest items across all libraries of a single server with one hub request
+        :param server:
+        :return: List of plex items
+        """
+        return server.fetchItems(
+            '/library/recentlyAdded',
+            container_start=0,
+            container_size=config.recently_added_max_results,
+            maxresults=config.recently_added_max_results
+        )
+
+    def get_server_resources(self):
+        """
+        Write the CPU, memory and bandwidth statistics of each server.  Plex returns the samples of the last few
+        minutes on every request, only samples newer than the last written ones are sent to InfluxDB
+        :return:
+        """
+        polled = self._poll_servers(
+            self._get_server_resources, 'server resources', self._due_servers('server_resources')
+        )
+        for server, points in polled.items():
+            log.debug('Found %s new resource samples on %s', len(points), server._baseurl)
+            if points:
+                self.write_influx_data(points)
+
+        state_file = config.state_file('server_resources.json')
+        if polled and state_file:
+            write_json(state_file, self.server_resources_written)
+
+    def _get_server_resources(self, server: PlexServer) -> List[dict]:
+        """
+        Get the resource and bandwidth samples of a single server that haven't been written yet
+        :param server:
+        :return: List of points
+        """
+        host = server._baseurl
+        written = self.server_resources_written.setdefault(host, {})
+        points = []
+
+        resources_after = written.get('resources', 0)
+        for sample in server.resources():
+            at = sample.at.timestamp()
+            if at <= resources_after:
+                continue
+            points.append({
+                'measurement': 'server_resources',
+                'fields': {
+                    'host_cpu_utilization': sample.hostCpuUtilization,
+                    'host_memory_utilization': sample.hostMemoryUtilization,
+                    'process_cpu_utilization': sample.processCpuUtilization,
+                    'process_memory_utilization': sample.processMemoryUtilization,
+                },
+                'tags': {
+                    'host': host
+                },
+                'time': int(at) * 1_000_000_000
+            })
+            written['resources'] = max(written.get('resources', 0), at)
+
+        bandwidth_after = written.get('bandwidth', 0)
+        filters = {'at>': datetime.fromtimestamp(bandwidth_after)} if bandwidth_after else {}
+        samples = [
+            sample for sample in server.bandwidth(timespan='seconds', **filters)
+            if sample.at.timestamp() > bandwidth_after
+        ]
+        if samples:
+            # The newest sample may still be counting bytes, it's written on the next run
+            newest = max(sample.at.timestamp() for sample in samples)
+            for sample in samples:
+                at = sample.at.timestamp()
+                if at >= newest:
+                    continue
+                points.append({
+                    'measurement': 'server_bandwidth',
+                    'fields': {
+                        'bytes': sample.bytes,
+                    },
+                    'tags': {
+                        'host': host,
+                        'location': 'lan' if sample.lan else 'wan',
+                        'account_id': sample.accountID,
+                        'device_id': sample.deviceID,
+                    },
+                    'time': int(at) * 1_000_000_000
+                })
+                written['bandwidth'] = max(written.get('bandwidth', 0), at)
+
+        return points
+
+    def get_history(self):
+        """
+        Write watch history entries added since the last run.  A server seen for the first time starts from now,
+        older entries can be loaded with backfill_history
+        :return:
+        """
+        servers = []
+        for server in self._due_servers('history'):
+            with self._history_lock:
+                ingesting = server._baseurl in self._history_ingesting
+            if ingesting:
+                log.info('Still catching up on the history of %s, skipping it this run', server._baseurl)
+            else:
+                servers.append(server)
+
+        for server, count in self._poll_servers(self._ingest_history, 'history', servers).items():
+            log.debug('Found %s new history entries on %s', count, server._baseurl)
+
+    def backfill_history(self, since: datetime):
+        """
+        Write every watch history entry viewed since a time.  Entries are fetched in pages and written in batches
+        as they come in, so memory use doesn't depend on how much history there is.  Servers are backfilled one
+        at a time without the server timeout
+        :param since:
+        :return:
+        """
+        for server in self._servers_with('history'):
+            log.info('Backfilling history of %s since %s', server._baseurl, since)
+            try:
+                count = self._ingest_history(server, since.timestamp())
+            except Exception as e:
+                log.error('Failed to backfill history of %s: %s', server._baseurl, e)
+                continue
+            log.info('Backfilled %s history entries from %s', count, server._baseurl)
+
+    def _ingest_history(self, server: PlexServer, since: float = None) -> int:
+        """
+        Page through the history of a server oldest first, starting at the newest entry written before or at since.
+        Pages are requested by viewedAt instead of by offset so entries added while paging don't shift the pages
+        :param server:
+        :param since: Timestamp to start at instead of the last written entry
+        :return: Number of entries written
+        """
+        host = server._baseurl
+        with self._history_lock:
+            self._history_ingesting.add(host)
+        try:
+            return self._ingest_history_pages(server, since)
+        finally:
+            with self._history_lock:
+                self._history_ingesting.discard(host)
+
+    def _ingest_history_pages(self, server: PlexServer, since: float = None) -> int:
+        host = server._baseurl
+        with self._history_lock:
+            written = self.history_written.get(host)
+        if written is None:
+            written = {'viewed_at': int(time.time()), 'keys': []}
+            self._save_history_watermark(host, written['viewed_at'], set())
+        viewed_at = written['viewed_at'] if since is None else since
+        # Entries viewed in the same second as the last written one are only skipped if they were written
+        seen = set(written['keys']) if viewed_at == written['viewed_at'] else set()
+        count = 0
+
+        while True:
+            # Like PlexServer.history, the operator in viewedAt>= must not be URL encoded
+            key = '/status/sessions/history/all' + plexapi.utils.joinArgs(
+                {'sort': 'viewedAt:asc', 'viewedAt>': int(viewed_at)}
+            )
+            with stats.timer('history_page', host):
+                fetched = server.fetchItems(
+                    key,
+                    container_start=0,
+                    container_size=config.history_page_size,
+                    maxresults=config.history_page_size
+                )
+            # A server that ignores the filter returns entries that were already passed
+            items = [
+                item for item in fetched
+                if getattr(item, 'viewedAt', None) and int(item.viewedAt.timestamp()) >= int(viewed_at)
+            ]
+
+            points = [
+                self._history_point(server, item) for item in items
+                if getattr(item, 'historyKey', None) and item.historyKey not in seen
+            ]
+            if points:
+                self.write_influx_data(points)
+                count += len(points)
+
+            if items:
+                newest = max(int(item.viewedAt.timestamp()) for item in items)
+                keys = {
+                    getattr(item, 'historyKey', None) for item in items if int(item.viewedAt.timestamp()) == newest
+                }
+                seen = seen | keys if newest == int(viewed_at) else keys
+                viewed_at = newest
+                self._save_history_watermark(host, viewed_at, seen)
+
+            if len(fetched) < config.history_page_size:
+                break
+            if not items:
+                log.warning('The history of %s ignored the viewedAt filter, stopping at %s', host, int(viewed_at))
+                break
+            if not points:
+                log.warning('More than %s history entries on %s were viewed at %s, skipping the rest of them',
+                            config.history_page_size, host, viewed_at)
+                viewed_at += 1
+
+        return count
+
+    def _save_history_watermark(self, host: str, viewed_at: float, keys: set):
+        with self._history_lock:
+            current = self.history_written.get(host)
+            # A backfill never moves the watermark back
+            if current is not None and current['viewed_at'] > viewed_at:
+                return
+            self.history_written[host] = {'viewed_at': viewed_at, 'keys': sorted(keys)}
+            state_file = config.state_file('history.json')
+            if state_file:
+                write_json(state_file, self.history_written)
+
+    def _history_point(self, server: PlexServer, item) -> dict:
+        """
+        Build a history point from a history entry
+        :param server:
+        :param item: Movie, Episode or Track from the history
+        :return:
+        """
+        prefix = getattr(item, 'grandparentTitle', None)
+        return {
+            'measurement': 'history',
+            'fields': {
+                'title': prefix + ' - ' + item.title if prefix else item.title,
+                'media_type': MEDIA_TYPES.get(item.type, 'Unknown'),
+                'rating_key': str(item.ratingKey),
+                'history_key': item.historyKey,
+                'account_id': item.accountID,
+                'device_id': item.deviceID,
+                'library_section_id': str(item.librarySectionID or ''),
+            },
+            'tags': {
+                'host': server._baseurl,
+                'user': self._history_name(server, 'accounts', item.accountID),
+                'device': self._history_name(server, 'devices', item.deviceID),
+            },
+            'time': int(item.viewedAt.timestamp()) * 1_000_000_000
+        }
+
+    def _history_name(self, server: PlexServer, kind: str, item_id: int) -> str:
+        """
+        Name of an account or device of a server.  The names are reloaded when an unknown ID shows up
+        :param server:
+        :param kind: accounts or devices
+        :param item_id: Account or device ID
+        :return: The name, or the ID if it's still unknown
+        """
+        names = self.history_names.setdefault(server._baseurl, {})
+        if item_id not in names.get(kind, {}):
+            cls = SystemAccount if kind == 'accounts' else SystemDevice
+            names[kind] = {item.id: item.name for item in server.fetchItems('/' + kind, cls)}
+            # Remember unknown IDs so they don't reload the names for every entry
+            names[kind].setdefault(item_id, str(item_id))
+        return names[kind][item_id]
 
     def _process_library_data(self, lib_data):
         """
@@ -352,12 +1419,7 @@ class PlexInfluxdbCollector:
 
         for host, data in lib_data.items():
             for lib in data:
-                fields = {
-                    'items': lib['items'],
-                }
-                for key in ['episodes', 'seasons']:
-                    if key in lib:
-                        fields[key] = lib[key]
+                fields = {key: value for key, value in lib.items() if key != 'tags'}
                 lib_points = [
                     {
                         'measurement': 'libraries',
@@ -372,31 +1434,141 @@ class PlexInfluxdbCollector:
 
     def write_influx_data(self, json_data):
         """
-        Writes the provided JSON to the database
+        Queue the provided JSON points for the next bulk write
         :param json_data:
         :return:
         """
+        stats.incr('points_collected', len(json_data))
+        if self.point_buffer.add(json_data):
+            self.flush_influx_data()
+
+    def flush_influx_data(self):
+        """
+        Write everything currently buffered to the database in batches.  While anything is spooled, or once a
+        write failed, batches are spooled straight away and the spool drainer is left to find out when InfluxDB
+        is back, so an outage doesn't hold every flush up for the write timeout
+        :return:
+        """
+        with self._write_lock:
+            spooling = self.spool is not None and not self.spool.empty()
+            for batch in self.point_buffer.drain():
+                if spooling:
+                    log.debug('Spooling %s points behind earlier failed writes', len(batch))
+                    self.spool.append(encode_points(batch))
+                elif not self._write_batch(batch):
+                    spooling = self.spool is not None
+
+    def _write_batch(self, json_data) -> bool:
+        """
+        Writes the provided JSON to the database
+        :param json_data:
+        :return: False if InfluxDB couldn't be reached
+        """
         log.debug(json_data)
 
+        body = encode_points(json_data)
         try:
-            self.influx_client.write_points(json_data)
-        except (InfluxDBClientError, ConnectionError, InfluxDBServerError) as e:
-            if hasattr(e, 'code') and e.code == 404:
-                log.error('Database {} Does Not Exist.  Attempting To Create')
-                self.influx_client.create_database(config.influx_database)
-                self.influx_client.write_points(json_data)
-                return
-            log.error('Failed to write data to InfluxDB')
+            with stats.timer('influx_write'):
+                self.influx_writer.write_lines(body)
+        except InfluxRejectedError as e:
+            stats.incr('write_rejections')
+            log.error('InfluxDB rejected {} points, dropping them: {}'.format(len(json_data), e))
+            return True
+        except InfluxWriteError as e:
+            stats.incr('write_failures')
+            if self.spool is None:
+                log.error('Failed to write data to InfluxDB: %s', e)
+                return False
+            log.error('Failed to write data to InfluxDB, spooling {} points: {}'.format(len(json_data), e))
+            self.spool.append(body)
+            return False
+
+        stats.incr('points_written', len(json_data))
+        log.debug('Written %s Points To Influx', len(json_data))
+        return True
+
+    def write_rollups(self, interval: int):
+        """
+        Write the rollups of the interval that just ended
+        :param interval: Seconds covered by the rollups
+        :return:
+        """
+        points = self.rollups.flush(interval)
+        if config.shard_count > 1:
+            # Shards roll up their own sessions, keep their points apart
+            for point in points:
+                point['tags']['shard'] = str(config.shard_index)
+        log.debug('Writing %s rollups of %ss', len(points), interval)
+        if points:
+            self.write_influx_data(points)
+
+    def get_collector_stats(self):
+        """
+        Write timings and counters of the collector itself to the collector_stats measurement
+        :return:
+        """
+        if self.spool is not None:
+            for name, value in self.spool.depth().items():
+                stats.set_gauge('spool_{}'.format(name), value)
+            stats.set_gauge('spool_dropped', self.spool.dropped)
+            stats.set_gauge('spool_replayed', self.spool.replayed)
+        stats.set_gauge('connected_servers', len(self.plex_servers))
+        stats.set_gauge('active_sessions', len(self.active_streams))
 
-        log.debug('Written To Influx: {}'.format(json_data))
+        self.write_influx_data(stats.points())
+
+    @staticmethod
+    def _record_request(response: requests.Response, *args, **kwargs):
+        """
+        requests response hook counting and timing every request to Plex servers and plex.tv
+        """
+        url = urlparse(response.url)
+        host = '{}://{}'.format(url.scheme, url.netloc)
+        stats.incr('plex_requests', host=host)
+        stats.observe('plex_request', response.elapsed.total_seconds(), host)
 
     def run(self):
 
-        log.info('Starting Monitoring Loop')
-        while True:
+        if self.backfill_since is not None:
+            self.discover_servers()
+            self.connect_servers()
+            if self.exit_code:
+                sys.exit(self.exit_code)
+            self.backfill_history(self.backfill_since)
+            self.flush_influx_data()
+            return
+
+        if self.single_run:
+            self.discover_servers()
+            self.connect_servers()
+            if self.exit_code:
+                sys.exit(self.exit_code)
             self.get_recently_added()
             self.get_library_data()
+            self.get_server_resources()
+            self.get_history()
             self.get_active_streams()
-            if self.single_run:
-                return
-            time.sleep(self.delay)
+            self.flush_influx_data()
+            self.active_streams.snapshot()
+            return
+
+        if self.spool is not None:
+            SpoolDrainer(
+                self.spool,
+                # Looked up on every replay so a reloaded InfluxDB target is used
+                lambda body: self.influx_writer.write_lines(body),
+                config.influx_batch_size,
+                config.influx_spool_max_backoff
+            ).start()
+
+        if config.metrics_port:
+            start_metrics_server(config.metrics_address, config.metrics_port)
+
+        # Signal handlers can only be set from the main thread
+        if hasattr(signal, 'SIGHUP') and threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGHUP, self._on_sighup)
+
+        log.info('Starting Monitoring Loop')
+        self.scheduler.run_forever()
+        if self.exit_code:
+            sys.exit(self.exit_code)
@@ -0,0 +1,56 @@
+from typing import Optional
+
+
+class AdaptiveInterval:
+    """
+    Session poll interval of one server.  Polls speed up to the minimum while sessions start, stop or change
+    state, settle back to the server's own interval while they keep playing and back off towards the maximum
+    while the server is idle.  Slow and failed polls back off further, failures exponentially
+    """
+
+    def __init__(self):
+        self.interval: Optional[float] = None
+        self.failures = 0
+        self._signature: Optional[frozenset] = None
+
+    def update(
+            self,
+            signature: Optional[frozenset],
+            latency: float,
+            base: float,
+            min_delay: float,
+            max_delay: float,
+            slow_latency: float
+    ) -> float:
+        """
+        Work out the interval until the next poll from the result of this one
+        :param signature: Session IDs and player states, or None if the poll failed
+        :param latency: Seconds the poll took
+        :param base: Interval of the server while sessions play without changing
+        :param min_delay: Shortest interval
+        :param max_delay: Longest interval
+        :param slow_latency: Polls slower than this many seconds back off
+        :return: Seconds until the next poll
+        """
+        base = min(max(base, min_delay), max_delay)
+        previous = self.interval if self.interval is not None else base
+
+        if signature is None:
+            self.failures += 1
+            interval = base * 2 ** self.failures
+        else:
+            self.failures = 0
+            changed = signature != self._signature
+            self._signature = signature
+            if latency > slow_latency:
+                interval = max(previous, base) * 1.5
+            elif changed:
+                interval = min_delay
+            elif signature:
+                # Still playing, ease back to the normal interval
+                interval = min(previous * 2, base)
+            else:
+                interval = max(previous, base) * 1.5
+
+        self.interval = min(max(interval, min_delay), max_delay)
+        return self.interval
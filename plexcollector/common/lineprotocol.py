@@ -0,0 +1,57 @@
+from typing import Iterable, Optional
+
+_MEASUREMENT_ESCAPES = str.maketrans({',': '\\,', ' ': '\\ ', '\n': '\\n'})
+_KEY_ESCAPES = str.maketrans({',': '\\,', '=': '\\=', ' ': '\\ ', '\n': '\\n'})
+_STRING_ESCAPES = str.maketrans({'"': '\\"', '\\': '\\\\', '\n': '\\n'})
+
+
+def _field_value(value) -> Optional[str]:
+    # bool is checked first as it's a subclass of int
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, int):
+        return '{}i'.format(value)
+    if isinstance(value, float):
+        return repr(value)
+    if value is None:
+        return None
+    return '"{}"'.format(str(value).translate(_STRING_ESCAPES))
+
+
+def encode_point(point: dict) -> Optional[str]:
+    """
+    Encode an InfluxDB JSON point as a line of line protocol.  Empty tags and None fields are left out
+    :param point: Dict with measurement, tags, fields and optionally time in nanoseconds
+    :return: The line, or None if the point has no fields
+    """
+    fields = []
+    for key, value in point['fields'].items():
+        value = _field_value(value)
+        if value is not None:
+            fields.append('{}={}'.format(key.translate(_KEY_ESCAPES), value))
+    if not fields:
+        return None
+
+    line = point['measurement'].translate(_MEASUREMENT_ESCAPES)
+    tags = point.get('tags')
+    if tags:
+        # Sorted tags are what InfluxDB stores, sending them sorted saves it the work
+        for key in sorted(tags):
+            value = tags[key]
+            if value is None or value == '':
+                continue
+            line += ',{}={}'.format(key.translate(_KEY_ESCAPES), str(value).translate(_KEY_ESCAPES))
+
+    line += ' ' + ','.join(fields)
+    if point.get('time') is not None:
+        line += ' {}'.format(int(point['time']))
+    return line
+
+
+def encode_points(points: Iterable[dict]) -> str:
+    """
+    Encode InfluxDB JSON points as a line protocol request body
+    :param points:
+    :return: str
+    """
+    return '\n'.join(line for line in map(encode_point, points) if line is not None)
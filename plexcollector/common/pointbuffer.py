@@ -0,0 +1,44 @@
+import threading
+import time
+from typing import List
+
+
+class PointBuffer:
+    """
+    Thread safe buffer collecting InfluxDB points so they can be written in bulk
+    """
+
+    def __init__(self, batch_size: int = 5000):
+        """
+        :param batch_size: Maximum number of points sent in a single write
+        """
+        self.batch_size = max(batch_size, 1)
+        self._points: List[dict] = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._points)
+
+    def add(self, points: List[dict]) -> bool:
+        """
+        Add points to the buffer.  Points are stamped with the time they were collected so the
+        delay until the flush doesn't shift them in InfluxDB
+        :param points: List of InfluxDB JSON points
+        :return: True if the buffer holds at least a full batch
+        """
+        stamp = time.time_ns()
+        with self._lock:
+            for point in points:
+                point.setdefault('time', stamp)
+            self._points.extend(points)
+            return len(self._points) >= self.batch_size
+
+    def drain(self) -> List[List[dict]]:
+        """
+        Empty the buffer
+        :return: Buffered points split in to batches of at most batch_size points
+        """
+        with self._lock:
+            points, self._points = self._points, []
+
+        return [points[i:i + self.batch_size] for i in range(0, len(points), self.batch_size)]
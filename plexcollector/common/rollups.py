@@ -0,0 +1,137 @@
+import threading
+import time
+from typing import Dict, Iterable, List
+
+
+class Rollups:
+    """
+    Watch time, transcode time, peak concurrent streams and number of sessions per user, title, player platform
+    and host, accumulated from every session sample and written once per interval.  Dashboards can read these
+    instead of grouping every now_playing sample at query time.
+
+    Time between two samples of a session is charged to what the first of them saw, like the session store does
+    """
+
+    def __init__(self, intervals: Iterable[int], max_gap: float):
+        """
+        :param intervals: Seconds covered by each rollup point, several intervals are kept side by side
+        :param max_gap: Samples further apart than this many seconds aren't charged the time between them
+        """
+        self.max_gap = max_gap
+        self._sessions: Dict[str, dict] = {}  # Session ID -> last sample
+        self._windows: Dict[int, dict] = {}  # Interval -> counters since the last flush
+        self._lock = threading.Lock()
+        self.set_intervals(intervals)
+
+    def set_intervals(self, intervals: Iterable[int]):
+        """
+        Start keeping new intervals and drop the ones no longer wanted
+        """
+        intervals = set(intervals)
+        with self._lock:
+            for interval in set(self._windows) - intervals:
+                del self._windows[interval]
+            for interval in intervals - set(self._windows):
+                self._windows[interval] = self._new_window()
+
+    def _new_window(self) -> dict:
+        window = {'start': time.time(), 'counters': {}}
+        self._count_streams(window)
+        return window
+
+    @staticmethod
+    def _counters(window: dict, dimension: str, key: str) -> dict:
+        counters = window['counters'].get((dimension, key))
+        if counters is None:
+            counters = window['counters'][(dimension, key)] = {
+                'watch_seconds': 0.0,
+                'transcode_seconds': 0.0,
+                'peak_streams': 0,
+                'sessions': set(),
+            }
+        return counters
+
+    def observe(self, session_id: str, state: str, transcoding: bool, **keys: str):
+        """
+        Record a sample of a session
+        :param session_id:
+        :param state: Player state (playing, paused, buffering)
+        :param transcoding: Whether any stream of the session is being transcoded
+        :param keys: Value of every dimension, e.g. user='jag'
+        :return:
+        """
+        now = time.time()
+        with self._lock:
+            previous = self._sessions.get(session_id)
+            self._sessions[session_id] = {'last_seen': now, 'state': state, 'transcoding': transcoding, 'keys': keys}
+
+            elapsed = 0.0
+            if previous is not None and now - previous['last_seen'] <= self.max_gap:
+                elapsed = now - previous['last_seen']
+            for window in self._windows.values():
+                for dimension, key in keys.items():
+                    self._counters(window, dimension, key)['sessions'].add(session_id)
+                if not elapsed:
+                    continue
+                for dimension, key in previous['keys'].items():
+                    counters = self._counters(window, dimension, key)
+                    if previous['state'] == 'playing':
+                        counters['watch_seconds'] += elapsed
+                    if previous['transcoding']:
+                        counters['transcode_seconds'] += elapsed
+
+    def end(self, session_id: str):
+        """
+        Forget a session that stopped
+        """
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def count_streams(self):
+        """
+        Update the peak concurrent streams with the sessions active now.  Called once all samples of a poll
+        were observed
+        :return:
+        """
+        with self._lock:
+            for window in self._windows.values():
+                self._count_streams(window)
+
+    def _count_streams(self, window: dict):
+        streams: Dict[tuple, int] = {}
+        for sample in self._sessions.values():
+            for dimension_key in sample['keys'].items():
+                streams[dimension_key] = streams.get(dimension_key, 0) + 1
+        for (dimension, key), count in streams.items():
+            counters = self._counters(window, dimension, key)
+            counters['peak_streams'] = max(counters['peak_streams'], count)
+
+    def flush(self, interval: int) -> List[dict]:
+        """
+        Close the current window of an interval and start the next one
+        :param interval:
+        :return: rollup_<dimension> points, timestamped with the start of the window
+        """
+        with self._lock:
+            window = self._windows.get(interval)
+            if window is None:
+                return []
+            self._windows[interval] = self._new_window()
+
+        points = []
+        for (dimension, key), counters in window['counters'].items():
+            points.append({
+                'measurement': 'rollup_{}'.format(dimension),
+                'fields': {
+                    'watch_seconds': counters['watch_seconds'],
+                    'transcode_seconds': counters['transcode_seconds'],
+                    'peak_streams': counters['peak_streams'],
+                    'sessions': len(counters['sessions']),
+                },
+                'tags': {
+                    dimension: key,
+                    'interval': '{}s'.format(interval),
+                },
+                'time': int(window['start'] * 1e9)
+            })
+        return points
@@ -0,0 +1,117 @@
+import threading
+import time
+from typing import Callable, Dict
+
+from plexcollector.common.stats import stats
+from plexcollector.common.utils import log
+
+
+class Job:
+    """
+    A collector function run on its own interval
+    """
+
+    def __init__(self, name: str, func: Callable[[], None], interval: float):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.next_run = time.monotonic()
+        self.running = False
+        self.overruns = 0  # Ticks skipped because the previous run was still going
+        self.last_duration = 0.0
+
+    def run(self):
+        start = time.monotonic()
+        try:
+            self.func()
+        except Exception:
+            log.exception('Job %s failed', self.name)
+        finally:
+            self.last_duration = time.monotonic() - start
+            self.running = False
+            stats.observe('job_{}'.format(self.name), self.last_duration)
+            log.debug('Job %s finished in %.2fs', self.name, self.last_duration)
+
+
+class Scheduler:
+    """
+    Runs each job on its own interval in its own thread, so a slow job never delays the others.
+    A job is never run twice at the same time. If a job is still running when it is due again the tick
+    is skipped and counted as an overrun, and missed ticks are coalesced in to a single run
+    """
+
+    def __init__(self):
+        self.jobs: Dict[str, Job] = {}
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+
+    def add_job(self, name: str, func: Callable[[], None], interval: float) -> Job:
+        job = Job(name, func, interval)
+        with self._lock:
+            self.jobs[name] = job
+        return job
+
+    def reschedule(self, name: str, interval: float):
+        """
+        Change the interval of a job.  Its next run moves to one new interval after its last scheduled run
+        """
+        with self._lock:
+            job = self.jobs.get(name)
+            if job is None:
+                return
+            job.next_run += interval - job.interval
+            job.interval = interval
+        self._wake.set()
+
+    def remove_job(self, name: str):
+        with self._lock:
+            self.jobs.pop(name, None)
+
+    def trigger(self, name: str):
+        """
+        Make a job due now
+        """
+        with self._lock:
+            job = self.jobs.get(name)
+        if job is not None:
+            job.next_run = time.monotonic()
+            self._wake.set()
+
+    def run_pending(self):
+        """
+        Start every job that is due
+        """
+        now = time.monotonic()
+        with self._lock:
+            jobs = list(self.jobs.values())
+
+        for job in jobs:
+            if now < job.next_run:
+                continue
+
+            job.next_run += job.interval
+            if job.next_run <= now:
+                # We fell behind, don't try to catch up on every missed tick
+                job.next_run = now + job.interval
+
+            if job.running:
+                job.overruns += 1
+                stats.incr('{}_overruns'.format(job.name))
+                log.warning('Job %s is still running after %.0fs, skipping this run', job.name, job.interval)
+                continue
+
+            job.running = True
+            threading.Thread(target=job.run, name='job-{}'.format(job.name), daemon=True).start()
+
+    def run_forever(self):
+        while not self._stop.is_set():
+            self.run_pending()
+            with self._lock:
+                next_run = min((job.next_run for job in self.jobs.values()), default=time.monotonic() + 1)
+            self._wake.wait(max(next_run - time.monotonic(), 0.01))
+            self._wake.clear()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
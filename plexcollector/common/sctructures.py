@@ -1,36 +1,129 @@
 import dataclasses
-from typing import Union, Optional
+import operator
+from typing import Union, Optional, Any, Dict
 
 from plexapi.audio import Track
-from plexapi.media import TranscodeSession, Media
+from plexapi.media import TranscodeSession, Media, Session
 from plexapi.video import Episode, Movie
 
 MEDIA_TYPE = Union[Episode, Movie, Track]
 
 
-@dataclasses.dataclass()
 class StreamData:
-    full_title: str = "Unknown"
-    resolution: str = ""
-    container: str = ""
-    audio_codec: str = ""
-    length_ms: int = 0
-    grandparent_title: str = ""
-    parent_title: str = ""
-    parent_index: str = ""
-    title: str = ""
-    index: str = ""
-    year: str = ""
-    player_state: str = ""
-    position: int = 0
-    pos_percent: float = 0.0
-    transcode_video: str = ""
-    transcode_audio: str = ""
-    transcode_summary: str = ""
-    video_codec: str = ""
-    video_framerate: str = ""
+    """
+    Metadata and transcode decisions of a stream.  Slotted and reset in place so the same instance can be
+    reused every time a session is polled
+    """
+    __slots__ = (
+        'full_title',
+        'resolution',
+        'container',
+        'audio_codec',
+        'length_ms',
+        'grandparent_title',
+        'parent_title',
+        'parent_index',
+        'title',
+        'index',
+        'year',
+        'player_state',
+        'position',
+        'pos_percent',
+        'transcode_video',
+        'transcode_audio',
+        'transcode_summary',
+        'video_codec',
+        'video_framerate',
+        'video_decision',
+        'audio_decision',
+        'transcode_hw_requested',
+        'transcode_hw_decoding',
+        'transcode_hw_encoding',
+        'transcode_hw_full_pipeline',
+        'transcode_speed',
+        'transcode_throttled',
+        'transcode_progress',
+        'bitrate',
+        'bandwidth',
+        'location',
+    )
+
+    full_title: str
+    resolution: str
+    container: str
+    audio_codec: str
+    length_ms: int
+    grandparent_title: str
+    parent_title: str
+    parent_index: str
+    title: str
+    index: str
+    year: str
+    player_state: str
+    position: int
+    pos_percent: float
+    transcode_video: str
+    transcode_audio: str
+    transcode_summary: str
+    video_codec: str
+    video_framerate: str
+    video_decision: str  # directplay, copy or transcode
+    audio_decision: str
+    transcode_hw_requested: bool
+    transcode_hw_decoding: str  # Hardware decoder in use, empty if decoding in software
+    transcode_hw_encoding: str
+    transcode_hw_full_pipeline: bool
+    transcode_speed: float
+    transcode_throttled: bool
+    transcode_progress: float
+    bitrate: int  # kbps of the source media
+    bandwidth: int  # kbps reserved for the session
+    location: str  # lan or wan
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.full_title = "Unknown"
+        self.resolution = ""
+        self.container = ""
+        self.audio_codec = ""
+        self.length_ms = 0
+        self.grandparent_title = ""
+        self.parent_title = ""
+        self.parent_index = ""
+        self.title = ""
+        self.index = ""
+        self.year = ""
+        self.player_state = ""
+        self.position = 0
+        self.pos_percent = 0.0
+        self.transcode_video = ""
+        self.transcode_audio = ""
+        self.transcode_summary = ""
+        self.video_codec = ""
+        self.video_framerate = ""
+        self.video_decision = ""
+        self.audio_decision = ""
+        self.transcode_hw_requested = False
+        self.transcode_hw_decoding = ""
+        self.transcode_hw_encoding = ""
+        self.transcode_hw_full_pipeline = False
+        self.transcode_speed = 0.0
+        self.transcode_throttled = False
+        self.transcode_progress = 0.0
+        self.bitrate = 0
+        self.bandwidth = 0
+        self.location = ""
+
+    def fields(self) -> Dict[str, Any]:
+        """
+        The stream data as a new dict of point fields
+        """
+        return dict(zip(self.__slots__, _stream_data_values(self)))
 
     def stream_processor(self, stream: MEDIA_TYPE):
+        self.reset()
         combined_video_transcodes = 0
         combined_audio_transcodes = 0
 
@@ -61,6 +154,17 @@ class StreamData:
 
         # Common fields
         self.audio_codec = media.audioCodec
+        self.bitrate = media.bitrate or 0
+        if stream.type != 'track':
+            self.video_codec = media.videoCodec or ""
+            self.video_framerate = media.videoFrameRate or ""
+
+        # Plex only includes the Session element when the stream uses bandwidth
+        session = get_session(stream)
+        if session is not None:
+            self.bandwidth = session.bandwidth or 0
+            self.location = session.location or ""
+
         transcode_session: Optional[TranscodeSession] = (
             getattr(
                 stream,
@@ -70,15 +174,34 @@ class StreamData:
         )[0]
 
         if transcode_session is not None:
-            if transcode_session.audioDecision == 'transcode':
-                self.transcode_audio = "Transcoding"
-                combined_audio_transcodes += 1
-                self.transcode_summary += "A: Yes"
+            self.video_decision = transcode_session.videoDecision or ""
+            self.audio_decision = transcode_session.audioDecision or ""
+            self.transcode_hw_requested = bool(transcode_session.transcodeHwRequested)
+            self.transcode_hw_decoding = transcode_session.transcodeHwDecoding or ""
+            self.transcode_hw_encoding = transcode_session.transcodeHwEncoding or ""
+            self.transcode_hw_full_pipeline = bool(transcode_session.transcodeHwFullPipeline)
+            self.transcode_speed = float(transcode_session.speed or 0)
+            self.transcode_throttled = bool(transcode_session.throttled)
+            self.transcode_progress = float(transcode_session.progress or 0)
+        else:
+            self.video_decision = "directplay"
+            self.audio_decision = "directplay"
+
+        if stream.type != 'track':
+            if self.video_decision == 'transcode':
+                self.transcode_video = "Transcoding"
+                combined_video_transcodes += 1
+                self.transcode_summary += "V: Yes "
             else:
-                self.transcode_audio = "DirectStream"
-                self.transcode_summary += "A: No"
+                self.transcode_video = "DirectPlay" if transcode_session is None else "DirectStream"
+                self.transcode_summary += "V: No "
+
+        if self.audio_decision == 'transcode':
+            self.transcode_audio = "Transcoding"
+            combined_audio_transcodes += 1
+            self.transcode_summary += "A: Yes"
         else:
-            self.transcode_audio = "DirectPlay"
+            self.transcode_audio = "DirectPlay" if transcode_session is None else "DirectStream"
             self.transcode_summary += "A: No"
 
         self.container = media.container
@@ -93,9 +216,91 @@ class StreamData:
 
         return self, combined_video_transcodes, combined_audio_transcodes
 
+    @property
+    def transcode_hw(self) -> bool:
+        """
+        Whether the transcode uses a hardware decoder or encoder
+        """
+        return bool(self.transcode_hw_decoding or self.transcode_hw_encoding)
+
+
+_stream_data_values = operator.attrgetter(*StreamData.__slots__)
+
+
+def get_session(stream: MEDIA_TYPE) -> Optional[Session]:
+    """
+    Get the Session element of a stream.  Older plexapi versions return a list from stream.session
+    """
+    session = getattr(stream, 'session', None)
+    if isinstance(session, list):
+        session = session[0] if session else None
+    return session
+
+
+def get_session_id(stream: MEDIA_TYPE, host: str) -> str:
+    """
+    Get a stable ID for a stream.  Plex only includes a Session element when the stream uses
+    bandwidth, fall back to the session key otherwise.  Session keys are only unique per server
+    so they are prefixed with the host
+    :param stream:
+    :param host: Server the stream is playing from
+    """
+    session = get_session(stream)
+    if session is not None and session.id:
+        return session.id
+    return '{}|{}'.format(host, stream.sessionKey)
+
+
+@dataclasses.dataclass()
+class LibraryScan:
+    watermark: Any
+    scanned_at: float
+    data: Dict[str, Any]
+
 
 MEDIA_TYPES = {
     'movie': 'Movie',
     'episode': 'TV Shows',
     'track': 'Music',
 }
+
+# Extra counts reported per library type, field name -> plex item type
+LIBRARY_CHILD_TYPES = {
+    'show': {
+        'seasons': 'season',
+        'episodes': 'episode',
+    },
+    'artist': {
+        'albums': 'album',
+        'tracks': 'track',
+    },
+}
+
+# active_streams fields, totals per host and across all hosts
+ACTIVE_STREAMS_FIELDS = (
+    'active_streams',
+    'video_transcodes',
+    'audio_transcodes',
+    'hw_transcodes',
+    'sw_transcodes',
+    'throttled_transcodes',
+    'bandwidth',
+    'lan_bandwidth',
+    'wan_bandwidth',
+)
+
+# now_playing fields that change while a session plays, the only ones written between full refreshes in delta mode
+NOW_PLAYING_VOLATILE_FIELDS = (
+    'state',
+    'player_state',
+    'duration',
+    'position',
+    'pos_percent',
+    'paused_time',
+    'transcode_time',
+    'bytes_sent',
+    'transcode_speed',
+    'transcode_throttled',
+    'transcode_progress',
+    'bandwidth',
+)
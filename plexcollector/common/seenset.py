@@ -0,0 +1,61 @@
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+from plexcollector.common.statefiles import read_json, write_json
+
+
+class SeenSet:
+    """
+    Bounded set of string keys that evicts the least recently seen key once full.
+    Optionally persisted to a JSON file so it survives restarts
+    """
+
+    def __init__(self, max_size: int = 5000, path: Optional[str] = None):
+        """
+        :param max_size: Maximum number of keys remembered
+        :param path: State file to load from and save to
+        """
+        self.max_size = max(max_size, 1)
+        self.path = path
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+        self._dirty = False
+
+        for key in read_json(path, default=[])[-self.max_size:]:
+            self._keys[key] = None
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._keys
+
+    def __len__(self):
+        return len(self._keys)
+
+    def add(self, key: str) -> bool:
+        """
+        Mark a key as seen
+        :param key:
+        :return: True if the key had not been seen before
+        """
+        with self._lock:
+            if key in self._keys:
+                self._keys.move_to_end(key)
+                return False
+
+            self._keys[key] = None
+            if len(self._keys) > self.max_size:
+                self._keys.popitem(last=False)
+            self._dirty = True
+            return True
+
+    def save(self):
+        """
+        Write the set to its state file if anything was added since the last save
+        """
+        if not self.path or not self._dirty:
+            return
+
+        with self._lock:
+            keys = list(self._keys)
+            self._dirty = False
+        write_json(self.path, keys)
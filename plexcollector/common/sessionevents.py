@@ -0,0 +1,107 @@
+import threading
+from typing import Callable, Dict, List, Optional
+
+from plexapi.alert import AlertListener
+from plexapi.server import PlexServer
+
+from plexcollector.common.sctructures import MEDIA_TYPE
+from plexcollector.common.utils import log
+
+
+class SessionTracker:
+    """
+    Keeps the active sessions of one server up to date from its websocket notifications.
+    Progress notifications are applied in place, the server is only asked for full session details
+    when a session starts or changes state
+    """
+
+    def __init__(self, server: PlexServer, on_change: Callable[[PlexServer], None]):
+        """
+        :param server: Server to listen to
+        :param on_change: Called with the server whenever a session starts, stops or changes state
+        """
+        self.server = server
+        self.sessions: Dict[int, MEDIA_TYPE] = {}  # sessionKey -> session
+        self._states: Dict[int, str] = {}
+        self._on_change = on_change
+        self._listener: Optional[AlertListener] = None
+        self._lock = threading.Lock()
+
+    @property
+    def alive(self) -> bool:
+        return self._listener is not None and self._listener.is_alive()
+
+    def start(self):
+        log.info('Listening for session notifications from %s', self.server._baseurl)
+        self._listener = self.server.startAlertListener(self._on_alert, self._on_error)
+
+    def stop(self):
+        if self.alive:
+            self._listener.stop()
+        self._listener = None
+
+    def snapshot(self) -> List[MEDIA_TYPE]:
+        with self._lock:
+            return list(self.sessions.values())
+
+    def reconcile(self, sessions: List[MEDIA_TYPE]):
+        """
+        Replace the tracked sessions with the result of a full poll
+        :param sessions: Result of server.sessions()
+        """
+        with self._lock:
+            self.sessions = {session.sessionKey: session for session in sessions}
+            self._states = {
+                session.sessionKey: getattr(session.players[0], 'state', None)
+                for session in sessions if session.players
+            }
+
+    def _on_alert(self, data: dict):
+        if data.get('type') != 'playing':
+            return
+
+        changed = False
+        to_refresh = {}
+        with self._lock:
+            for notification in data.get('PlaySessionStateNotification', []):
+                session_key = int(notification['sessionKey'])
+                state = notification.get('state')
+                session = self.sessions.get(session_key)
+
+                if state == 'stopped':
+                    if self.sessions.pop(session_key, None) is not None:
+                        self._states.pop(session_key, None)
+                        changed = True
+                elif session is None or self._states.get(session_key) != state:
+                    to_refresh[session_key] = state
+                elif 'viewOffset' in notification:
+                    session.viewOffset = int(notification['viewOffset'])
+
+        if to_refresh:
+            self._refresh(to_refresh)
+        if changed or to_refresh:
+            self._on_change(self.server)
+
+    def _refresh(self, states: Dict[int, str]):
+        """
+        Fetch full details for sessions that started or changed state
+        :param states: sessionKey -> state from the notification
+        """
+        try:
+            current = {session.sessionKey: session for session in self.server.sessions()}
+        except Exception as e:
+            log.error('Failed to refresh sessions from %s: %s', self.server._baseurl, e)
+            return
+
+        with self._lock:
+            for session_key, state in states.items():
+                session = current.get(session_key)
+                if session is None:
+                    self.sessions.pop(session_key, None)
+                    self._states.pop(session_key, None)
+                    continue
+                self.sessions[session_key] = session
+                self._states[session_key] = state
+
+    def _on_error(self, error):
+        log.error('Session notifications from %s failed: %s', self.server._baseurl, error)
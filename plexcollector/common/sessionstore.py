@@ -0,0 +1,205 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import closing
+from typing import Dict, Iterable, List, Optional
+
+from plexcollector.common.statefiles import read_json, write_json
+from plexcollector.common.utils import log
+
+
+class SessionStore:
+    """
+    In memory state of active sessions.  Besides when a session was first seen it keeps running totals
+    of time per player state, paused time, transcode time and bytes sent, updated every time the session is
+    sampled, and the latest metadata of the session
+    """
+
+    def __init__(self, expiry: int = 600):
+        """
+        :param expiry: Seconds after which a session that hasn't been seen is dropped when state is restored
+        """
+        self.expiry = expiry
+        self._sessions: Dict[str, dict] = {}
+        self._lock = threading.RLock()
+
+    def __contains__(self, session_id: str) -> bool:
+        return session_id in self._sessions
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def get(self, session_id: str) -> Optional[dict]:
+        return self._sessions.get(session_id)
+
+    def update(
+            self,
+            session_id: str,
+            host: str,
+            state: str,
+            transcoding: bool,
+            bandwidth: int = None,
+            details: dict = None
+    ) -> dict:
+        """
+        Record a sample of a session, adding the time since the previous sample to its totals
+        :param session_id:
+        :param host: Server the session is playing from
+        :param state: Player state (playing, paused, buffering)
+        :param transcoding: Whether any stream of the session is being transcoded
+        :param bandwidth: Session bandwidth in kbps, if known
+        :param details: Latest metadata of the session, kept for the summary written when it ends
+        :return: The session record
+        """
+        now = time.time()
+        with self._lock:
+            record = self._sessions.get(session_id)
+            if record is None:
+                record = self._sessions[session_id] = {
+                    'host': host,
+                    'start_time': now,
+                    'last_seen': now,
+                    'state': state,
+                    'paused_time': 0.0,
+                    'transcode_time': 0.0,
+                    'bytes': 0,
+                    'state_times': {},
+                }
+
+            elapsed = now - record['last_seen']
+            if record.pop('restored', False):
+                # Don't charge the time the collector was down to the session
+                elapsed = 0
+            # Totals are charged to the state seen at the start of the interval
+            state_times = record.setdefault('state_times', {})
+            state_times[record['state']] = state_times.get(record['state'], 0.0) + elapsed
+            if record['state'] == 'paused':
+                record['paused_time'] += elapsed
+            if record.get('transcoding'):
+                record['transcode_time'] += elapsed
+            if record.get('bandwidth'):
+                record['bytes'] += int(record['bandwidth'] * 125 * elapsed)  # kbps -> bytes
+
+            record.update(last_seen=now, state=state, transcoding=transcoding, bandwidth=bandwidth)
+            if details is not None:
+                record['details'] = details
+            return record
+
+    def remove_missing(self, hosts: Iterable[str], current: Iterable[str]) -> List[dict]:
+        """
+        Remove sessions of the given hosts that are no longer active.  Sessions of hosts that weren't
+        polled are left alone until they expire
+        :param hosts: Hosts that were polled
+        :param current: Session IDs that are still active
+        :return: Removed session records
+        """
+        hosts = set(hosts)
+        current = set(current)
+        cutoff = time.time() - self.expiry
+        with self._lock:
+            ended = [
+                session_id for session_id, record in self._sessions.items()
+                if session_id not in current and (record['host'] in hosts or record['last_seen'] < cutoff)
+            ]
+            return [dict(self._sessions.pop(session_id), session_id=session_id) for session_id in ended]
+
+    def _restore(self, sessions: Dict[str, dict]):
+        cutoff = time.time() - self.expiry
+        with self._lock:
+            self._sessions = {
+                session_id: dict(record, restored=True)
+                for session_id, record in sessions.items() if record['last_seen'] >= cutoff
+            }
+        log.info('Restored {} active sessions ({} expired)'.format(
+            len(self._sessions), len(sessions) - len(self._sessions)
+        ))
+
+    def _copy(self) -> Dict[str, dict]:
+        with self._lock:
+            return {session_id: dict(record) for session_id, record in self._sessions.items()}
+
+    def restore(self):
+        """
+        Load saved state, dropping sessions that have expired
+        """
+
+    def snapshot(self):
+        """
+        Save the current state
+        """
+
+
+class FileSessionStore(SessionStore):
+    """
+    Session store snapshotted to a JSON file
+    """
+
+    def __init__(self, path: str, expiry: int = 600):
+        super().__init__(expiry)
+        self.path = path
+
+    def restore(self):
+        self._restore(read_json(self.path, default={}))
+
+    def snapshot(self):
+        write_json(self.path, self._copy())
+
+
+class SQLiteSessionStore(SessionStore):
+    """
+    Session store snapshotted to a SQLite database
+    """
+
+    def __init__(self, path: str, expiry: int = 600):
+        super().__init__(expiry)
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with closing(self._connect()) as db, db:
+            db.execute('CREATE TABLE IF NOT EXISTS sessions (session_id TEXT PRIMARY KEY, data TEXT NOT NULL)')
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    def restore(self):
+        with closing(self._connect()) as db, db:
+            rows = db.execute('SELECT session_id, data FROM sessions').fetchall()
+        self._restore({session_id: json.loads(data) for session_id, data in rows})
+
+    def snapshot(self):
+        sessions = self._copy()
+        try:
+            # Replace the whole table in one transaction so a snapshot is never half written
+            with closing(self._connect()) as db, db:
+                db.execute('DELETE FROM sessions')
+                db.executemany(
+                    'INSERT INTO sessions (session_id, data) VALUES (?, ?)',
+                    [(session_id, json.dumps(record)) for session_id, record in sessions.items()]
+                )
+        except sqlite3.Error as e:
+            log.error('Unable to save sessions to %s: %s', self.path, e)
+
+
+def create_session_store(backend: str, state_file, expiry: int) -> SessionStore:
+    """
+    Build the configured session store
+    :param backend: memory, file or sqlite
+    :param state_file: Callable returning the path of a file in the state directory
+    :param expiry: Seconds after which unseen sessions are dropped on restore
+    :return: SessionStore
+    """
+    backend = backend.lower()
+    if backend == 'file' and state_file('sessions.json'):
+        store = FileSessionStore(state_file('sessions.json'), expiry)
+    elif backend == 'sqlite' and state_file('sessions.db'):
+        store = SQLiteSessionStore(state_file('sessions.db'), expiry)
+    else:
+        if backend in ('file', 'sqlite'):
+            log.warning('Session store %s needs a StateDir, keeping sessions in memory', backend)
+        elif backend != 'memory':
+            log.warning('Unknown session store %s, keeping sessions in memory', backend)
+        store = SessionStore(expiry)
+
+    store.restore()
+    return store
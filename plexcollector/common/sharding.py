@@ -0,0 +1,133 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from contextlib import closing
+from typing import Dict, List, Optional
+
+from plexcollector.common.utils import log
+
+
+def shard_of(address: str, shard_count: int) -> int:
+    """
+    Shard a server belongs to.  Rendezvous hashing, so changing the shard count only moves the servers that
+    have to move instead of reshuffling all of them
+    :param address: Server address as configured
+    :param shard_count:
+    :return: Shard index, from 0 to shard_count - 1
+    """
+    def weight(shard: int) -> int:
+        digest = hashlib.md5('{}:{}'.format(shard, address).encode('utf-8')).digest()
+        return int.from_bytes(digest[:8], 'big')
+
+    return max(range(shard_count), key=weight)
+
+
+def shard_addresses(addresses: List[str], shard_index: int, shard_count: int) -> List[str]:
+    """
+    Servers polled by one collector instance
+    :param addresses: Every configured server address
+    :param shard_index: Index of this instance
+    :param shard_count: Number of instances
+    :return:
+    """
+    if shard_count <= 1:
+        return list(addresses)
+    return [address for address in addresses if shard_of(address, shard_count) == shard_index]
+
+
+class ShardCoordinator:
+    """
+    Coordinates collector instances sharing a directory.  Each instance publishes the totals of its own servers,
+    and whichever instance holds the leader lease combines them, so singleton points are written exactly once.
+    The lease expires when its holder stops renewing it, letting another instance take over
+    """
+
+    def __init__(self, path: str, shard_index: int, lease_ttl: float):
+        self.path = path
+        self.shard_index = shard_index
+        self.lease_ttl = lease_ttl
+        # Shard indexes are unique, so a restarted leader takes its lease straight back
+        self.owner = 'shard-{}'.format(shard_index)
+        self.is_leader = False
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with closing(self._connect()) as db, db:
+            db.execute('CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, owner TEXT NOT NULL, '
+                       'expires REAL NOT NULL)')
+            db.execute('CREATE TABLE IF NOT EXISTS totals (name TEXT NOT NULL, shard INTEGER NOT NULL, '
+                       'updated REAL NOT NULL, data TEXT NOT NULL, PRIMARY KEY (name, shard))')
+
+    def _connect(self):
+        # Autocommit, transactions are started explicitly so the lease check and renewal can't interleave
+        return sqlite3.connect(self.path, timeout=10, isolation_level=None)
+
+    def acquire(self, name: str = 'leader') -> bool:
+        """
+        Take or renew a lease
+        :param name: Lease name
+        :return: Whether this instance holds the lease
+        """
+        now = time.time()
+        try:
+            with closing(self._connect()) as db:
+                db.execute('BEGIN IMMEDIATE')
+                try:
+                    row = db.execute('SELECT owner, expires FROM leases WHERE name = ?', (name,)).fetchone()
+                    leader = row is None or row[0] == self.owner or row[1] < now
+                    if leader:
+                        db.execute(
+                            'INSERT OR REPLACE INTO leases (name, owner, expires) VALUES (?, ?, ?)',
+                            (name, self.owner, now + self.lease_ttl)
+                        )
+                    db.execute('COMMIT')
+                except sqlite3.Error:
+                    db.execute('ROLLBACK')
+                    raise
+        except sqlite3.Error as e:
+            log.error('Unable to check the %s lease in %s: %s', name, self.path, e)
+            leader = False
+
+        if leader != self.is_leader:
+            log.info('%s the %s lease', 'Acquired' if leader else 'Lost', name)
+            self.is_leader = leader
+        return leader
+
+    def publish(self, name: str, data: Dict[str, float]):
+        """
+        Share the totals of this instance
+        :param name: What the totals are, e.g. active_streams
+        :param data:
+        :return:
+        """
+        try:
+            with closing(self._connect()) as db:
+                db.execute(
+                    'INSERT OR REPLACE INTO totals (name, shard, updated, data) VALUES (?, ?, ?, ?)',
+                    (name, self.shard_index, time.time(), json.dumps(data))
+                )
+        except sqlite3.Error as e:
+            log.error('Unable to publish %s totals to %s: %s', name, self.path, e)
+
+    def combined(self, name: str) -> Optional[Dict[str, float]]:
+        """
+        Sum the totals published by every instance within the lease TTL, older totals belong to instances
+        that stopped
+        :param name: What the totals are
+        :return: Summed totals, or None if they couldn't be read
+        """
+        try:
+            with closing(self._connect()) as db:
+                rows = db.execute(
+                    'SELECT data FROM totals WHERE name = ? AND updated >= ?',
+                    (name, time.time() - self.lease_ttl)
+                ).fetchall()
+        except sqlite3.Error as e:
+            log.error('Unable to read %s totals from %s: %s', name, self.path, e)
+            return None
+
+        combined = {}
+        for data, in rows:
+            for key, value in json.loads(data).items():
+                combined[key] = combined.get(key, 0) + value
+        return combined
@@ -0,0 +1,162 @@
+import os
+import threading
+import time
+from typing import Callable, List, Optional
+
+from plexcollector.common.utils import log
+from plexcollector.common.writers import InfluxRejectedError
+
+
+class Spool:
+    """
+    Bounded on disk queue of line protocol that failed to be written.  Data is appended to segment files
+    which are rotated once they reach segment_size.  The oldest segments are dropped when the spool grows
+    past max_size bytes or holds data older than max_age seconds
+    """
+
+    def __init__(self, directory: str, max_size: int, max_age: int, segment_size: int = 1024 * 1024):
+        self.directory = directory
+        self.max_size = max_size
+        self.max_age = max_age
+        self.segment_size = segment_size
+        self.dropped = 0  # Segments dropped because of the size or age limits
+        self.replayed = 0  # Segments written to InfluxDB after an outage
+        self._active: Optional[str] = None
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _segments(self) -> List[str]:
+        # Segment names are creation times in nanoseconds, so sorting by name sorts by age
+        names = sorted(
+            (name for name in os.listdir(self.directory) if name.endswith('.lp')),
+            key=lambda name: int(name[:-3])
+        )
+        return [os.path.join(self.directory, name) for name in names]
+
+    def append(self, body: str):
+        """
+        Add line protocol to the spool
+        :param body:
+        :return:
+        """
+        with self._lock:
+            if self._active is None:
+                self._active = os.path.join(self.directory, '{}.lp'.format(time.time_ns()))
+            with open(self._active, 'a', encoding='utf-8') as f:
+                f.write(body)
+                f.write('\n')
+                if f.tell() >= self.segment_size:
+                    self._active = None
+            self._enforce_limits()
+
+    def _enforce_limits(self):
+        segments = self._segments()
+        sizes = {path: os.path.getsize(path) for path in segments}
+        total = sum(sizes.values())
+        cutoff = time.time_ns() - self.max_age * 1_000_000_000
+
+        for path in segments:
+            too_old = int(os.path.basename(path)[:-3]) < cutoff
+            if not too_old and total <= self.max_size:
+                break
+            log.warning('Spool limit reached, dropping %s', path)
+            total -= sizes[path]
+            self._remove(path)
+            self.dropped += 1
+
+    def _remove(self, path: str):
+        if path == self._active:
+            self._active = None
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def oldest(self) -> Optional[str]:
+        """
+        The oldest segment, closing the active segment if it is the only one left
+        :return: Path of the segment or None if the spool is empty
+        """
+        with self._lock:
+            segments = self._segments()
+            if not segments:
+                return None
+            if segments[0] == self._active:
+                self._active = None
+            return segments[0]
+
+    def remove(self, path: str):
+        with self._lock:
+            self._remove(path)
+            self.replayed += 1
+
+    def empty(self) -> bool:
+        with self._lock:
+            return not self._segments()
+
+    def depth(self) -> dict:
+        """
+        Number of segments and bytes waiting in the spool
+        """
+        with self._lock:
+            segments = self._segments()
+            return {
+                'segments': len(segments),
+                'bytes': sum(os.path.getsize(path) for path in segments),
+            }
+
+
+class SpoolDrainer(threading.Thread):
+    """
+    Replays spooled segments in order, backing off exponentially while writes keep failing
+    """
+
+    def __init__(self, spool: Spool, write_lines: Callable[[str], None], batch_size: int, max_backoff: int):
+        """
+        :param spool:
+        :param write_lines: Writes a line protocol body, raises on failure
+        :param batch_size: Maximum lines per write
+        :param max_backoff: Maximum seconds between retries
+        """
+        super().__init__(name='spool-drainer', daemon=True)
+        self.spool = spool
+        self.write_lines = write_lines
+        self.batch_size = batch_size
+        self.max_backoff = max_backoff
+        self._stop = threading.Event()
+
+    def run(self):
+        backoff = 1
+        while not self._stop.is_set():
+            path = self.spool.oldest()
+            if path is None:
+                self._stop.wait(5)
+                continue
+
+            try:
+                self._replay(path)
+            except Exception as e:
+                log.warning('Replaying spooled data failed, retrying in %ss: %s', backoff, e)
+                self._stop.wait(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+                continue
+
+            backoff = 1
+            self.spool.remove(path)
+            log.info('Replayed spooled data from %s', path)
+
+    def _replay(self, path: str):
+        with open(path, encoding='utf-8') as f:
+            lines = [line for line in f.read().splitlines() if line]
+
+        # A segment that fails half way is replayed from the start, rewriting identical points is harmless
+        for i in range(0, len(lines), self.batch_size):
+            try:
+                self.write_lines('\n'.join(lines[i:i + self.batch_size]))
+            except InfluxRejectedError as e:
+                # Retrying would hold back everything spooled after it
+                log.error('InfluxDB rejected spooled data from %s, dropping %s lines: %s',
+                          path, len(lines[i:i + self.batch_size]), e)
+
+    def stop(self):
+        self._stop.set()
@@ -0,0 +1,43 @@
+import json
+import os
+import tempfile
+
+from plexcollector.common.utils import log
+
+
+def read_json(path: str, default=None):
+    """
+    Load a JSON state file
+    :param path: Path to the file
+    :param default: Returned if the file doesn't exist or can't be read
+    :return:
+    """
+    if not path or not os.path.isfile(path):
+        return default
+
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        log.warning('Unable to read state file %s: %s', path, e)
+        return default
+
+
+def write_json(path: str, data):
+    """
+    Atomically replace a JSON state file, a crash mid write never leaves a truncated file behind
+    :param path: Path to the file
+    :param data: JSON serializable data
+    :return:
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-', suffix='.json')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f, separators=(',', ':'))
+        os.replace(tmp_path, path)
+    except OSError as e:
+        log.error('Unable to write state file %s: %s', path, e)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
@@ -0,0 +1,190 @@
+import bisect
+import math
+import random
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Tuple
+
+from plexcollector.common.utils import log
+
+# Upper bounds in seconds of the latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, math.inf)
+# Values sampled per window for the percentiles, so memory stays bounded however long a window lasts
+WINDOW_SAMPLES = 1024
+
+
+class Histogram:
+    """
+    Latency histogram.  Keeps cumulative buckets for Prometheus and a window that is reset every time
+    it is reported to InfluxDB.  The window's count, mean and max are exact, its percentiles come from a
+    uniform sample of at most WINDOW_SAMPLES values
+    """
+
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self._reset_window()
+
+    def _reset_window(self):
+        self._window: List[float] = []
+        self._window_count = 0
+        self._window_sum = 0.0
+        self._window_max = 0.0
+
+    def observe(self, value: float):
+        self.buckets[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+        self._window_count += 1
+        self._window_sum += value
+        self._window_max = max(self._window_max, value)
+        if len(self._window) < WINDOW_SAMPLES:
+            self._window.append(value)
+        else:
+            # Reservoir sampling, every value of the window is kept with the same probability
+            index = random.randrange(self._window_count)
+            if index < WINDOW_SAMPLES:
+                self._window[index] = value
+
+    def window(self) -> dict:
+        """
+        Summary of the values observed since the last call
+        """
+        values, count, total, maximum = sorted(self._window), self._window_count, self._window_sum, self._window_max
+        self._reset_window()
+        if not values:
+            return {}
+        return {
+            'count': count,
+            'mean': total / count,
+            'max': maximum,
+            'p50': values[int(len(values) * 0.5)],
+            'p95': values[min(int(len(values) * 0.95), len(values) - 1)],
+        }
+
+
+class CollectorStats:
+    """
+    Timings, counters and gauges describing the collector itself
+    """
+
+    def __init__(self):
+        self._histograms: Dict[Tuple[str, str], Histogram] = {}
+        self._counters: Dict[Tuple[str, str], int] = {}
+        self._gauges: Dict[Tuple[str, str], float] = {}
+        self._lock = threading.Lock()
+        self.tags: Dict[str, str] = {}  # Added to every collector_stats point
+
+    def observe(self, stage: str, seconds: float, host: str = ''):
+        with self._lock:
+            histogram = self._histograms.get((stage, host))
+            if histogram is None:
+                histogram = self._histograms[(stage, host)] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, stage: str, host: str = ''):
+        """
+        Time the body of a with block as a stage
+        """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.monotonic() - start, host)
+
+    def incr(self, name: str, value: int = 1, host: str = ''):
+        with self._lock:
+            self._counters[(name, host)] = self._counters.get((name, host), 0) + value
+
+    def set_gauge(self, name: str, value: float, host: str = ''):
+        with self._lock:
+            self._gauges[(name, host)] = value
+
+    def points(self) -> List[dict]:
+        """
+        Build collector_stats points.  Timings cover the period since the previous call, counters are totals
+        since the collector started
+        """
+        points = []
+        with self._lock:
+            for (stage, host), histogram in self._histograms.items():
+                fields = histogram.window()
+                if fields:
+                    points.append(self._point(fields, stage=stage, host=host))
+
+            per_host = {}
+            for values in (self._counters, self._gauges):
+                for (name, host), value in values.items():
+                    per_host.setdefault(host, {})[name] = value
+
+        for host, fields in per_host.items():
+            points.append(self._point(fields, host=host))
+        return points
+
+    def _point(self, fields: dict, **tags) -> dict:
+        tags.update(self.tags)
+        return {
+            'measurement': 'collector_stats',
+            'fields': fields,
+            'tags': {key: value for key, value in tags.items() if value}
+        }
+
+    def prometheus(self) -> str:
+        """
+        Render everything in the Prometheus text format
+        """
+        lines = ['# TYPE plexcollector_stage_seconds histogram']
+        with self._lock:
+            for (stage, host), histogram in sorted(self._histograms.items()):
+                labels = 'stage="{}",host="{}"'.format(stage, host)
+                cumulative = 0
+                for bound, count in zip(BUCKETS, histogram.buckets):
+                    cumulative += count
+                    le = '+Inf' if bound == math.inf else repr(bound)
+                    lines.append('plexcollector_stage_seconds_bucket{{{},le="{}"}} {}'.format(labels, le, cumulative))
+                lines.append('plexcollector_stage_seconds_sum{{{}}} {}'.format(labels, histogram.sum))
+                lines.append('plexcollector_stage_seconds_count{{{}}} {}'.format(labels, histogram.count))
+
+            for kind, suffix, values in (('counter', '_total', self._counters), ('gauge', '', self._gauges)):
+                for name in sorted({name for name, _ in values}):
+                    metric = 'plexcollector_{}{}'.format(name, suffix)
+                    lines.append('# TYPE {} {}'.format(metric, kind))
+                    for (value_name, host), value in sorted(values.items()):
+                        if value_name == name:
+                            lines.append('{}{{host="{}"}} {}'.format(metric, host, value))
+
+        return '\n'.join(lines) + '\n'
+
+
+stats = CollectorStats()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = stats.prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug('Metrics request: ' + format, *args)
+
+
+def start_metrics_server(address: str, port: int) -> ThreadingHTTPServer:
+    """
+    Serve /metrics in the Prometheus text format from a background thread
+    """
+    server = ThreadingHTTPServer((address, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    log.info('Serving metrics on http://%s:%s/metrics', address, port)
+    return server
@@ -0,0 +1,184 @@
+import gzip
+import sys
+from typing import List
+
+import requests
+from influxdb import InfluxDBClient
+from influxdb.exceptions import InfluxDBClientError, InfluxDBServerError
+
+from plexcollector.common.lineprotocol import encode_points
+from plexcollector.common.utils import log
+
+
+class InfluxWriteError(Exception):
+    pass
+
+
+class InfluxRejectedError(InfluxWriteError):
+    """
+    InfluxDB refused the points themselves, e.g. a field type conflict.  Writing them again won't help
+    """
+
+
+def _rejected(status_code: int) -> bool:
+    # Missing databases and rate limits clear up, other client errors are about the points
+    return 400 <= status_code < 500 and status_code not in (404, 429)
+
+
+class InfluxWriter:
+    """
+    Writes points to InfluxDB as line protocol
+    """
+
+    def check_connection(self):
+        """
+        Make sure InfluxDB can be reached with the configured credentials.  Exits if it can't
+        """
+
+    def write(self, points: List[dict]):
+        """
+        Write InfluxDB JSON points
+        :param points:
+        :return:
+        """
+        body = encode_points(points)
+        if body:
+            self.write_lines(body)
+
+    def write_lines(self, body: str):
+        """
+        Write a line protocol body.  Raises InfluxWriteError if the write failed, InfluxRejectedError if it
+        shouldn't be retried
+        :param body:
+        :return:
+        """
+        raise NotImplementedError
+
+
+class InfluxDBv1Writer(InfluxWriter):
+    """
+    Writer for InfluxDB 1.x using a database and username/password
+    """
+
+    def __init__(self, config):
+        self.database = config.influx_database
+        self.address = config.influx_address
+        self.client = InfluxDBClient(
+            host=config.influx_address,
+            port=config.influx_port,
+            database=config.influx_database,
+            ssl=config.influx_ssl,
+            verify_ssl=config.influx_verify_ssl,
+            username=config.influx_user,
+            password=config.influx_password,
+            timeout=5,
+            # Failed writes are spooled and replayed, retrying here would hold up the collector
+            retries=1,
+            gzip=config.influx_gzip
+        )
+
+    def check_connection(self):
+        """
+        We test with the get all users command.  If the address is bad it fails
+        with a 404.  If the user doesn't have permission it fails with 401
+        """
+        # TODO - Check what permissions are actually needed to make this work
+        try:
+            log.debug('Testing connection to InfluxDb using provided credentials')
+            self.client.get_list_users()  # TODO - Find better way to test connection and permissions
+            log.debug('Successful connection to InfluxDb')
+        except (requests.exceptions.ConnectTimeout, InfluxDBClientError) as e:
+            if isinstance(e, requests.exceptions.ConnectTimeout):
+                log.critical('Unable to connect to InfluxDB at the provided address (%s)', self.address)
+            elif e.code == 401:
+                log.critical('Unable to connect to InfluxDB with provided credentials')
+
+            sys.exit(1)
+
+    def write_lines(self, body: str):
+        params = {'db': self.database, 'precision': 'n'}
+        try:
+            try:
+                self.client.write(body, params=params, protocol='line')
+            except InfluxDBClientError as e:
+                if e.code != 404:
+                    raise
+                log.error('Database {} Does Not Exist.  Attempting To Create'.format(self.database))
+                self.client.create_database(self.database)
+                self.client.write(body, params=params, protocol='line')
+        except InfluxDBClientError as e:
+            if e.code is not None and _rejected(e.code):
+                raise InfluxRejectedError(e) from e
+            raise InfluxWriteError(e) from e
+        except (InfluxDBServerError, requests.exceptions.RequestException) as e:
+            raise InfluxWriteError(e) from e
+
+
+class InfluxDBv2Writer(InfluxWriter):
+    """
+    Writer for InfluxDB 2.x using a token, organization and bucket
+    """
+
+    def __init__(self, config):
+        scheme = 'https' if config.influx_ssl else 'http'
+        self.url = '{}://{}:{}'.format(scheme, config.influx_address, config.influx_port)
+        self.org = config.influx_org
+        self.bucket = config.influx_bucket
+        self.gzip = config.influx_gzip
+        self.session = requests.Session()
+        self.session.verify = config.influx_verify_ssl
+        self.session.headers['Authorization'] = 'Token {}'.format(config.influx_token)
+
+    def check_connection(self):
+        try:
+            log.debug('Testing connection to InfluxDb using provided token')
+            r = self.session.get(self.url + '/api/v2/buckets', params={'name': self.bucket}, timeout=5)
+        except requests.exceptions.RequestException:
+            log.critical('Unable to connect to InfluxDB at the provided address (%s)', self.url)
+            sys.exit(1)
+
+        if r.status_code == 401:
+            log.critical('Unable to connect to InfluxDB with provided token')
+            sys.exit(1)
+        if r.ok and not r.json().get('buckets'):
+            log.critical('Bucket %s does not exist', self.bucket)
+            sys.exit(1)
+        log.debug('Successful connection to InfluxDb')
+
+    def write_lines(self, body: str):
+        data = body.encode('utf-8')
+        headers = {'Content-Type': 'text/plain; charset=utf-8'}
+        if self.gzip:
+            data = gzip.compress(data, compresslevel=5)
+            headers['Content-Encoding'] = 'gzip'
+
+        try:
+            r = self.session.post(
+                self.url + '/api/v2/write',
+                params={'org': self.org, 'bucket': self.bucket, 'precision': 'ns'},
+                data=data,
+                headers=headers,
+                timeout=5
+            )
+        except requests.exceptions.RequestException as e:
+            raise InfluxWriteError(e) from e
+
+        if _rejected(r.status_code):
+            raise InfluxRejectedError('{} {}'.format(r.status_code, r.text))
+        if r.status_code != 204:
+            raise InfluxWriteError('{} {}'.format(r.status_code, r.text))
+
+
+def create_writer(config) -> InfluxWriter:
+    """
+    Build the writer for the configured InfluxDB version and check it can connect
+    :param config: ConfigManager
+    :return: InfluxWriter
+    """
+    if config.influx_version == 2:
+        writer = InfluxDBv2Writer(config)
+    else:
+        writer = InfluxDBv1Writer(config)
+
+    writer.check_connection()
+    return writer
@@ -1,10 +1,66 @@
 import configparser
+import copy
 import os
 import sys
-from typing import Tuple, Iterable
+from dataclasses import dataclass, field
+from typing import Dict, FrozenSet, List, Optional, Tuple
 
 import requests
 
+from plexcollector.transport import PooledSession
+
+# Collectors that can be enabled per server and the GENERAL key of the interval they run on
+COLLECTOR_INTERVALS = {
+    'sessions': 'Delay',
+    'recently_added': 'RecentlyAddedDelay',
+    'libraries': 'LibraryDelay',
+    'history': 'HistoryDelay',
+    'server_resources': 'ServerResourcesDelay',
+}
+
+# Settings only read when the collector starts, reloading the config keeps their current values
+RESTART_SETTINGS = (
+    'state_dir', 'session_store', 'influx_spool', 'influx_spool_max_size', 'influx_spool_max_age',
+    'influx_spool_max_backoff', 'plex_pool_size', 'plex_retries', 'plex_retry_backoff', 'shard_index',
+    'shard_count', 'shared_dir', 'lease_ttl', 'metrics_address', 'metrics_port', 'poll_workers', 'server_timeout',
+)
+
+# Settings the InfluxDB writer is built from
+INFLUX_SETTINGS = (
+    'influx_version', 'influx_address', 'influx_port', 'influx_database', 'influx_ssl', 'influx_verify_ssl',
+    'influx_user', 'influx_password', 'influx_token', 'influx_org', 'influx_bucket', 'influx_gzip',
+)
+
+
+@dataclass
+class ServerConfig:
+    """
+    How to connect to a Plex server and what to collect from it.  With discover set it describes a plex.tv account
+    instead, and the servers found on that account are collected with its settings
+    """
+    name: str
+    url: str = ''
+    alternate_urls: Tuple[str, ...] = ()  # Tried in order when url can't be reached
+    token: str = field(default='', repr=False)
+    username: str = ''
+    password: str = field(default='', repr=False)
+    verify_ssl: bool = False
+    discover: bool = False
+    collectors: FrozenSet[str] = frozenset(COLLECTOR_INTERVALS)
+    intervals: Dict[str, int] = field(default_factory=dict)  # Seconds between runs of each collector
+
+    def enabled(self, collector: str) -> bool:
+        return collector in self.collectors and self.intervals.get(collector, 0) > 0
+
+    def same_connection(self, other: 'ServerConfig') -> bool:
+        """
+        Whether a connection made with these settings can be kept for the other settings
+        """
+        return (
+            (self.url, self.alternate_urls, self.token, self.username, self.password, self.verify_ssl)
+            == (other.url, other.alternate_urls, other.token, other.username, other.password, other.verify_ssl)
+        )
+
 
 class ConfigManager:
 
@@ -12,16 +68,20 @@ class ConfigManager:
 
         print('Loading config: ' + config)
 
-        config_file = os.path.join(os.getcwd(), config)
-        if os.path.isfile(config_file):
+        self.config_file = os.path.join(os.getcwd(), config)
+        if os.path.isfile(self.config_file):
+            self.config_mtime = os.path.getmtime(self.config_file)
             self.config = configparser.ConfigParser()
-            self.config.read(config_file)
+            self.config.read(self.config_file)
         else:
-            print('ERROR: Unable To Load Config File: {}'.format(config_file))
+            print('ERROR: Unable To Load Config File: {}'.format(self.config_file))
             sys.exit(1)
 
         self._load_config_values()
-        self._validate_plex_servers()
+        self.shard_override: Optional[Tuple[int, int]] = None  # Shard index and count set from the command line
+        self.http_sessions: Dict[bool, requests.Session] = {}
+        # Session for plex.tv, which always has a valid certificate whatever Verify_SSL says about the servers
+        self.http_session = self.http_session_for(True)
         print('Configuration Successfully Loaded')
 
     def _load_config_values(self):
@@ -29,10 +89,41 @@ class ConfigManager:
         # General
         general = self.config['GENERAL']
         self.delay = general.getint('Delay', fallback=2)
+        self.config_reload_delay = general.getint('ConfigReloadDelay', fallback=30)
+        self.realtime_sessions = general.getboolean('RealtimeSessions', fallback=False)
+        self.session_reconcile_delay = general.getint('SessionReconcileDelay', fallback=300)
+        self.adaptive_sessions = general.getboolean('AdaptiveSessions', fallback=False)
+        self.session_min_delay = general.getint('SessionMinDelay', fallback=2)
+        self.session_max_delay = general.getint('SessionMaxDelay', fallback=120)
+        self.session_slow_latency = general.getfloat('SessionSlowLatency', fallback=2)
+        self.session_store = general.get('SessionStore', fallback='file')
+        self.session_snapshot_interval = general.getint('SessionSnapshotInterval', fallback=30)
+        self.session_expiry = general.getint('SessionExpiry', fallback=600)
+        self.now_playing_delta = general.getboolean('NowPlayingDelta', fallback=False)
+        self.now_playing_full_refresh = general.getint('NowPlayingFullRefresh', fallback=300)
+        self.session_summaries = general.getboolean('SessionSummaries', fallback=True)
+        self.recently_added_delay = general.getint('RecentlyAddedDelay', fallback=300)
+        self.library_delay = general.getint('LibraryDelay', fallback=3600)
+        self.library_count_only = general.getboolean('LibraryCountOnly', fallback=True)
+        self.library_incremental = general.getboolean('LibraryIncremental', fallback=True)
+        self.library_rescan_delay = general.getint('LibraryRescanDelay', fallback=86400)
+        self.server_resources_delay = general.getint('ServerResourcesDelay', fallback=60)
+        self.history_delay = general.getint('HistoryDelay', fallback=300)
+        self.history_page_size = general.getint('HistoryPageSize', fallback=500)
         self.report_combined = general.getboolean('ReportCombined', fallback=True)
+        self.rollup_intervals = [
+            int(interval) for interval in general.get('RollupIntervals', fallback='60').split(',')
+            if interval.strip() and int(interval) > 0
+        ]
+        self.recently_added_max_results = general.getint('RecentlyAddedMaxResults', fallback=50)
+        self.recently_added_seen_size = general.getint('RecentlyAddedSeenSize', fallback=5000)
+        self.state_dir = general.get('StateDir', fallback='state')
+        self.poll_workers = general.getint('PollWorkers', fallback=8)
+        self.server_timeout = general.getint('ServerTimeout', fallback=30)
 
         # InfluxDB
         influx = self.config['INFLUXDB']
+        self.influx_version = influx.getint('Version', fallback=1)
         self.influx_address = influx['Address']
         self.influx_port = influx.getint('Port', fallback=8086)
         self.influx_database = influx.get('Database', fallback='plex_data')
@@ -40,59 +131,251 @@ class ConfigManager:
         self.influx_verify_ssl = influx.getboolean('Verify_SSL', fallback=True)
         self.influx_user = influx.get('Username', fallback='')
         self.influx_password = influx.get('Password', fallback='', raw=True)
+        self.influx_token = influx.get('Token', fallback='', raw=True)
+        self.influx_org = influx.get('Org', fallback='')
+        self.influx_bucket = influx.get('Bucket', fallback=self.influx_database)
+        self.influx_gzip = influx.getboolean('Gzip', fallback=False)
+        self.influx_spool = influx.getboolean('Spool', fallback=True)
+        self.influx_spool_max_size = influx.getint('SpoolMaxSize', fallback=100)
+        self.influx_spool_max_age = influx.getint('SpoolMaxAge', fallback=86400)
+        self.influx_spool_max_backoff = influx.getint('SpoolMaxBackoff', fallback=300)
+        self.influx_batch_size = influx.getint('BatchSize', fallback=5000)
+        self.influx_flush_interval = influx.getint('FlushInterval', fallback=0)
 
         # Plex
         plex = self.config['PLEX']
-        self.plex_user = plex['Username']
-        self.plex_password = plex.get('Password', raw=True)
+        self.plex_user = plex.get('Username', fallback='')
+        self.plex_password = plex.get('Password', fallback='', raw=True)
+        self.plex_token = plex.get('Token', fallback='', raw=True)
         plex_https = plex.getboolean('HTTPS', fallback=False)
         self.conn_security = 'https' if plex_https else 'http'
         self.port = plex.getint('Port', fallback=32469 if plex_https else 32400)
         self.plex_verify_ssl = plex.getboolean('Verify_SSL', fallback=False)
-        servers = len(plex['Servers'])
+        self.token_cache_ttl = plex.getint('TokenCacheTTL', fallback=604800)
+        self.reconnect_delay = plex.getint('ReconnectDelay', fallback=60)
+        self.discover_delay = plex.getint('DiscoverDelay', fallback=3600)
+        self.plex_pool_size = plex.getint('PoolSize', fallback=10)
+        self.plex_retries = plex.getint('Retries', fallback=3)
+        self.plex_retry_backoff = plex.getfloat('RetryBackoff', fallback=0.5)
+        self.plex_servers = self._load_servers()
+
+        # Sharding
+        self.shard_index = self.config.getint('SHARDING', 'ShardIndex', fallback=0)
+        self.shard_count = self.config.getint('SHARDING', 'ShardCount', fallback=1)
+        self.shared_dir = self.config.get('SHARDING', 'SharedDir', fallback='')
+        lease_ttl = self.config.get('SHARDING', 'LeaseTTL', fallback='')
+        self.lease_ttl = int(lease_ttl) if lease_ttl else max(self.delay * 3, 30)
+
+        # Collector statistics
+        self.stats_interval = self.config.getint('STATS', 'Interval', fallback=60)
+        self.metrics_address = self.config.get('STATS', 'MetricsAddress', fallback='0.0.0.0')
+        self.metrics_port = self.config.getint('STATS', 'MetricsPort', fallback=0)
 
         # Logging
         self.logging_level = self.config['LOGGING']['Level'].upper()
 
-        if servers:
-            self.plex_server_addresses = plex['Servers'].replace(' ', '').split(',')
-        else:
+        if not self.plex_servers:
             print('ERROR: No Plex Servers Provided.\nAborting!')
             sys.exit(1)
 
-    def url(self, server):
-        return '{}://{}:{}'.format(self.conn_security, server, self.port)
+        self._check_shard(self.shard_index, self.shard_count)
 
-    @property
-    def urls(self):
-        return map(self.url, self.plex_server_addresses)
+    def changed(self) -> bool:
+        """
+        Whether the config file was modified since it was loaded
+        """
+        try:
+            return os.path.getmtime(self.config_file) != self.config_mtime
+        except OSError:
+            return False
+
+    def reload(self) -> Optional[List[str]]:
+        """
+        Load the config file again.  Nothing changes unless the whole file loads, and settings in RESTART_SETTINGS
+        keep their current values
+        :return: Restart only settings that changed in the file, or None if the file couldn't be loaded
+        """
+        loaded = copy.copy(self)
+        loaded.config = configparser.ConfigParser()
+        try:
+            # A file that fails to load isn't tried again until it is modified
+            self.config_mtime = loaded.config_mtime = os.path.getmtime(self.config_file)
+            if not loaded.config.read(self.config_file):
+                raise OSError('Unable to read the file')
+            loaded._load_config_values()
+            if self.shard_override is not None:
+                loaded.shard_index, loaded.shard_count = self.shard_override
+        except (OSError, configparser.Error, KeyError, ValueError) as e:
+            print('ERROR: Unable To Reload Config File: {} ({})'.format(self.config_file, e))
+            return None
+        except SystemExit:
+            # The loader exits on invalid settings after printing why, a running collector keeps going
+            return None
+
+        ignored = [name for name in RESTART_SETTINGS if getattr(loaded, name) != getattr(self, name)]
+        for name in RESTART_SETTINGS:
+            setattr(loaded, name, getattr(self, name))
+        self.__dict__.update(vars(loaded))
+        return ignored
+
+    def influx_settings(self) -> tuple:
+        return tuple(getattr(self, name) for name in INFLUX_SETTINGS)
 
-    @property
-    def servers_url(self) -> Iterable[Tuple[str, str]]:
-        return map(lambda x: (x, self.url(x)), self.plex_server_addresses)
+    def _load_servers(self) -> Dict[str, ServerConfig]:
+        """
+        Build the servers from the Servers list and Discover setting of PLEX, which share its account and settings,
+        and from PLEX:name sections with their own
+        :return: Dict of server name to its settings
+        """
+        plex = self.config['PLEX']
+        account = {
+            'token': self.plex_token,
+            'username': self.plex_user,
+            'password': self.plex_password,
+            'verify_ssl': self.plex_verify_ssl,
+            'intervals': {
+                'sessions': self.delay,
+                'recently_added': self.recently_added_delay,
+                'libraries': self.library_delay,
+                'history': self.history_delay,
+                'server_resources': self.server_resources_delay,
+            },
+        }
+        servers = {}
+        for address in plex.get('Servers', fallback='').replace(' ', '').split(','):
+            if address:
+                servers[address] = ServerConfig(address, url=self.url(address), **account)
+        if plex.getboolean('Discover', fallback=False):
+            servers['PLEX'] = ServerConfig('PLEX', discover=True, **account)
+
+        for section in self.config.sections():
+            if section.startswith('PLEX:'):
+                name = section[len('PLEX:'):].strip()
+                servers[name] = self._load_server(name, self.config[section], account)
 
-    def _validate_plex_servers(self):
+        for server in servers.values():
+            if not server.token and not server.username:
+                print('ERROR: Plex server {} has no Token or Username'.format(server.name))
+                sys.exit(1)
+        return servers
+
+    @staticmethod
+    def _load_server(name: str, section: configparser.SectionProxy, account: dict) -> ServerConfig:
         """
-        Make sure the servers provided in the config can be resolved.  Abort if they can't
+        Build a server from its own PLEX:name section.  Anything not set is taken from PLEX and GENERAL
+        :param name: Server name
+        :param section: PLEX:name section
+        :param account: Settings of the PLEX section
         :return:
         """
-        failed_servers = []
-        for server, server_url in self.servers_url:
-            try:
-                r = requests.get(server_url, verify=self.plex_verify_ssl)
-                if r.status_code == 401:
-                    continue
-                print('Unexpected status code {} from Plex server'.format(str(r.status_code)))
-            except ConnectionError:
-                print('Failed to connect to Plex server', server)
-                failed_servers.append(server)
-
-        # Do we have any valid servers left?
-        # TODO This check is failing even with no bad servers
-        if len(self.plex_server_addresses) > len(failed_servers):
-            print('INFO: Found {} Bad Server(s).  Removing Them From List'.format(str(len(failed_servers))))
-            for server in failed_servers:
-                self.plex_server_addresses.remove(server)
-        else:
-            print('ERROR: No Valid Servers Provided.  Check Server Addresses And Try Again')
+        discover = section.getboolean('Discover', fallback=False)
+        url = section.get('URL', fallback='')
+        if not url and 'Address' in section:
+            https = section.getboolean('HTTPS', fallback=False)
+            url = '{}://{}:{}'.format(
+                'https' if https else 'http',
+                section['Address'],
+                section.getint('Port', fallback=32469 if https else 32400)
+            )
+        if not url and not discover:
+            print('ERROR: Plex server {} needs a URL, an Address or Discover = True'.format(name))
             sys.exit(1)
+
+        collectors = frozenset(COLLECTOR_INTERVALS)
+        if 'Collectors' in section:
+            collectors = frozenset(c.strip() for c in section['Collectors'].split(',') if c.strip())
+            unknown = collectors - set(COLLECTOR_INTERVALS)
+            if unknown:
+                print('ERROR: Unknown collectors for Plex server {}: {}. Valid options are: {}'.format(
+                    name, ', '.join(sorted(unknown)), ', '.join(COLLECTOR_INTERVALS)
+                ))
+                sys.exit(1)
+
+        # Credentials come together, a server with its own token or username doesn't use the PLEX account
+        own_account = 'Token' in section or 'Username' in section
+        return ServerConfig(
+            name,
+            url=url.rstrip('/'),
+            token=section.get('Token', fallback='', raw=True) if own_account else account['token'],
+            username=section.get('Username', fallback='') if own_account else account['username'],
+            password=section.get('Password', fallback='', raw=True) if own_account else account['password'],
+            verify_ssl=section.getboolean('Verify_SSL', fallback=account['verify_ssl']),
+            discover=discover,
+            collectors=collectors,
+            intervals={
+                collector: section.getint(key, fallback=account['intervals'][collector])
+                for collector, key in COLLECTOR_INTERVALS.items()
+            }
+        )
+
+    @staticmethod
+    def _check_shard(shard_index: int, shard_count: int):
+        """
+        Exit if a shard doesn't exist
+        """
+        if shard_count < 1 or not 0 <= shard_index < shard_count:
+            print('ERROR: Shard index must be between 0 and {}, got {}'.format(shard_count - 1, shard_index))
+            sys.exit(1)
+
+    def set_shard(self, shard_index: int, shard_count: int):
+        """
+        Set the shard this instance polls from the command line, overriding the config file also when it is
+        reloaded.  Exits if the shard doesn't exist
+        :param shard_index: Index of this instance, from 0 to shard_count - 1
+        :param shard_count: Number of instances the servers are split between
+        :return:
+        """
+        self._check_shard(shard_index, shard_count)
+        self.shard_index = shard_index
+        self.shard_count = shard_count
+        self.shard_override = (shard_index, shard_count)
+
+    def shared_file(self, name):
+        """
+        Path of a file in the directory shared by every shard, or None if shards aren't coordinated
+        :param name: File name
+        :return:
+        """
+        if self.shard_count <= 1 or not self.shared_dir:
+            return None
+        return os.path.join(os.getcwd(), self.shared_dir, name)
+
+    def _build_http_session(self, verify: bool) -> requests.Session:
+        """
+        Build the pooled session shared by every request to Plex servers and plex.tv
+        :param verify: Verify TLS certificates
+        :return:
+        """
+        return PooledSession(
+            verify=verify,
+            pool_size=self.plex_pool_size,
+            retries=self.plex_retries,
+            backoff=self.plex_retry_backoff,
+            timeout=self.server_timeout
+        )
+
+    def http_session_for(self, verify: bool) -> requests.Session:
+        """
+        Pooled session for servers with a TLS verification setting, servers with the same setting share one
+        :param verify: Verify TLS certificates
+        :return:
+        """
+        if verify not in self.http_sessions:
+            self.http_sessions[verify] = self._build_http_session(verify)
+        return self.http_sessions[verify]
+
+    def state_file(self, name):
+        """
+        Path of a file in the state directory, or None if state isn't persisted
+        :param name: File name
+        :return:
+        """
+        if not self.state_dir:
+            return None
+        if self.shard_count > 1:
+            # Shards running side by side must not overwrite each other's state
+            return os.path.join(os.getcwd(), self.state_dir, 'shard-{}'.format(self.shard_index), name)
+        return os.path.join(os.getcwd(), self.state_dir, name)
+
+    def url(self, server):
+        return '{}://{}:{}'.format(self.conn_security, server, self.port)
@@ -0,0 +1,45 @@
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Hosts whose connection pools are kept.  Pools are only created for hosts that are used, past this the least
+# recently used pool is closed, so it is well above the number of servers a collector polls
+POOL_HOSTS = 256
+
+
+class PooledSession(requests.Session):
+    """
+    requests Session with a default timeout and a pooled, retrying adapter.  Connections are kept alive
+    and reused per host, so a polling cycle doesn't pay a new TCP and TLS handshake for every request
+    """
+
+    def __init__(self, verify=True, pool_size=10, retries=3, backoff=0.5, timeout=30, pool_hosts=POOL_HOSTS):
+        """
+        :param verify: Verify TLS certificates
+        :param pool_size: Connections kept open per host
+        :param retries: Retries for failed connections and 502/503/504 responses of idempotent requests
+        :param backoff: Backoff factor between retries in seconds
+        :param timeout: Default timeout of a request in seconds
+        :param pool_hosts: Hosts whose connection pools are kept
+        """
+        super().__init__()
+        self.verify = verify
+        self.timeout = timeout
+
+        adapter = HTTPAdapter(
+            pool_connections=pool_hosts,
+            pool_maxsize=pool_size,
+            max_retries=Retry(
+                total=retries,
+                backoff_factor=backoff,
+                status_forcelist=(502, 503, 504),
+                raise_on_status=False
+            )
+        )
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return super().request(method, url, **kwargs)